@@ -9,7 +9,7 @@ setup(
     author_email="martin.clyde.weiss@gmail.com",
     packages=find_packages(),
     include_package_data=True,
-    install_requires=["click", "rich", "submitit", "wandb", "numpy", "stopit", "google-cloud-storage", "dill", "gcloud"],
+    install_requires=["click", "rich", "submitit", "wandb", "numpy", "stopit", "google-cloud-storage>=2.10", "dill", "gcloud", "watchdog"],
     entry_points={
         "console_scripts": [
             "submit = wormulon.submit:main",
@@ -21,6 +21,7 @@ setup(
             "show_jobs = wormulon.tpu.utils:show_jobs",
             "delete_jobs = wormulon.tpu.utils:delete_jobs",
             "show_experiments = wormulon.tpu.utils:show_experiments",
+            "gc_checkpoints = wormulon.tpu.utils:gc_checkpoints",
             "show_tpus = wormulon.tpu.utils:show_tpus",
             "delete_all_tpus = wormulon.tpu.utils:delete_all_tpus",
             "nuke_exps = wormulon.tpu.utils:nuke_exps"
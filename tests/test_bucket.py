@@ -0,0 +1,88 @@
+import pickle
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("google.cloud.storage")
+
+from wormulon.tpu import bucket as bucket_module
+from wormulon.tpu.bucket import Bucket
+
+
+class FakeBlob(object):
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def exists(self):
+        return self.name in self.store
+
+    def upload_from_string(self, data):
+        self.store[self.name] = data
+
+
+class FakeBucket(object):
+    def __init__(self, store):
+        self.store = store
+
+    def blob(self, name):
+        return FakeBlob(self.store, name)
+
+    def get_blob(self, name):
+        return FakeBlob(self.store, name) if name in self.store else None
+
+
+class FakeHttp(object):
+    def mount(self, prefix, adapter):
+        pass
+
+
+class CountingClient(object):
+    """Stands in for storage.Client, counting how many clients get built."""
+
+    built = 0
+
+    def __init__(self):
+        CountingClient.built += 1
+        self._http = FakeHttp()
+        self.store = dict()
+
+    def bucket(self, name):
+        return FakeBucket(self.store)
+
+    def list_blobs(self, bucket_name, prefix=None, match_glob=None, delimiter=None):
+        return [FakeBlob(self.store, name) for name in self.store if name.startswith(prefix or "")]
+
+
+@pytest.fixture
+def counting_client(monkeypatch):
+    CountingClient.built = 0
+    monkeypatch.setattr(bucket_module.storage, "Client", CountingClient)
+    return CountingClient
+
+
+def test_client_is_built_once(counting_client):
+    bucket = Bucket("test-bucket")
+    bucket.upload("exp/jobstate.yml", "state: 0")
+    assert bucket.exists("exp/jobstate.yml")
+    assert bucket.get_blob("exp/jobstate.yml") is not None
+    assert [blob.name for blob in bucket.list(prefix="exp")] == ["exp/jobstate.yml"]
+    bucket.upload("exp/jobstate.yml", "state: 1", overwrite=True)
+    assert counting_client.built == 1
+
+
+def test_unpickled_bucket_rebuilds_its_client(counting_client):
+    bucket = Bucket("test-bucket")
+    bucket.exists("exp/jobstate.yml")
+    bucket = pickle.loads(pickle.dumps(bucket))
+    assert bucket._client is None
+    bucket.exists("exp/jobstate.yml")
+    assert counting_client.built == 2
+
+
+def test_old_pickles_get_defaults(counting_client):
+    # A Bucket pickled before clients were cached only has a name and last_touch.
+    bucket = Bucket.__new__(Bucket)
+    bucket.__setstate__({"name": "test-bucket", "last_touch": 0})
+    assert bucket.cache is None
+    bucket.exists("exp/jobstate.yml")
+    assert counting_client.built == 1
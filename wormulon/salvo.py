@@ -10,7 +10,10 @@ import time
 import click
 import submitit
 import pathlib
+from collections import defaultdict, deque
 from submitit.core.utils import CommandFunction
+from wormulon.submit import PackedCommands
+from wormulon.utils import dump_yaml
 
 try:
     from raven.core import RavenJob as Job
@@ -19,10 +22,17 @@ except ImportError:
     from wormulon.core import Job
     from wormulon.utils import JobState
 
+# Maximum number of jobs in one Slurm job array when launching with --batch.
+BATCH_SIZE = 500
+# Seconds between checks of the submitted jobs while --max-in-flight or --max-queued holds back a launch.
+BACKPRESSURE_INTERVAL = 30
+
 
 class Salvo(object):
     def __init__(self):
         self.executor = None
+        # Submitted jobs that have not finished yet, by job id.
+        self.in_flight = dict()
         # Args
         self._argv = None
         self._salvo_arg_block = None
@@ -193,15 +203,7 @@ class Salvo(object):
             )
         )["generator"](self.param_generator_args)
 
-    def launch_one_job(
-        self,
-        job_idx,
-        kwargs,
-        script_path,
-        template_args,
-        is_dry_run=False,
-        use_abs_path=False,
-    ):
+    def prepare_job(self, job_idx, kwargs, script_path, template_args, use_abs_path=False):
         job_kwargs = {"job_idx": job_idx, "uuid": uuid.uuid4().hex, **kwargs}
         script_args = [arg.format(**job_kwargs) for arg in template_args]
         if use_abs_path:
@@ -219,14 +221,30 @@ class Salvo(object):
             f"[bold green]{script_path}[/bold green] "
             f"[bold magenta]{' '.join(script_args)}[/bold magenta]"
         )
+        command.extend([script_path, *script_args])
+        return command, script_path, script_args
+
+    def launch_one_job(
+        self,
+        job_idx,
+        kwargs,
+        script_path,
+        template_args,
+        is_dry_run=False,
+        use_abs_path=False,
+    ):
+        command, script_path, script_args = self.prepare_job(
+            job_idx, kwargs, script_path, template_args, use_abs_path=use_abs_path
+        )
 
         if is_dry_run:
             job = None
         else:
-            command.extend([script_path, *script_args])
             # Setup Submitit
+            self.wait_for_capacity()
             self.executor = self._build_executor(script_args[0])
             job = self.executor.submit(CommandFunction(command))
+            self.track(job)
 
         job_info = {
             "job": job,
@@ -235,6 +253,113 @@ class Salvo(object):
         }
         return job_info
 
+    def launch_grouped(self, generator, script_path, template_args, group_size, submit, is_dry_run=False,
+                       use_abs_path=False):
+        """Groups the jobs whose experiment directories share a parent directory, and calls submit(directory,
+        jobs) for every group_size of them. Yields the job_info of each job once it is submitted."""
+        pending = defaultdict(list)
+        for job_idx, kwargs in enumerate(generator):
+            command, job_script_path, script_args = self.prepare_job(
+                job_idx, kwargs, script_path, template_args, use_abs_path=use_abs_path
+            )
+            job_info = {
+                "job": None,
+                "script_path": job_script_path,
+                "script_args": script_args,
+            }
+            if is_dry_run:
+                yield job_info
+                continue
+            directory = os.path.dirname(os.path.abspath(script_args[0]))
+            pending[directory].append((command, job_info))
+            if len(pending[directory]) >= group_size:
+                jobs = pending.pop(directory)
+                submit(directory, jobs)
+                yield from (job_info for _, job_info in jobs)
+        for directory, jobs in pending.items():
+            submit(directory, jobs)
+            yield from (job_info for _, job_info in jobs)
+
+    def launch_batched(self, generator, script_path, template_args, is_dry_run=False, use_abs_path=False):
+        """Submits the jobs as Slurm job arrays. Jobs whose experiment directories share a parent directory
+        go in the same array (of at most --batch-size jobs), with one executor and one sbatch per array."""
+        batch_size = int(self.get_salvo_arg("--batch-size", BATCH_SIZE))
+        return self.launch_grouped(
+            generator, script_path, template_args, batch_size, self.submit_batch,
+            is_dry_run=is_dry_run, use_abs_path=use_abs_path,
+        )
+
+    def submit_batch(self, directory, jobs):
+        # The array logs to directory/Logs, and every job's own Logs folder gets links to its files.
+        self.wait_for_capacity(len(jobs))
+        self.executor = self._build_executor(directory)
+        if self.executor.cluster == "slurm" and self.get_salvo_arg("--array-parallelism") is not None:
+            self.executor.update_parameters(slurm_array_parallelism=int(self.get_salvo_arg("--array-parallelism")))
+        rich.print(f":package: [bold]Submitting an array of {len(jobs)} jobs[/bold]")
+        with self.executor.batch():
+            submitted = [self.executor.submit(CommandFunction(command)) for command, _ in jobs]
+        for job, (_, job_info) in zip(submitted, jobs):
+            job_info["job"] = job
+            self.track(job)
+            self.link_job_logs(job, job_info["script_args"][0])
+
+    def launch_packed(self, generator, script_path, template_args, is_dry_run=False, use_abs_path=False):
+        """Runs --pack N generated configs per job, concurrently inside the job's allocation. Every config
+        logs to packed.out, .err and .exit in its own experiment directory's Logs folder."""
+        return self.launch_grouped(
+            generator, script_path, template_args, int(self.get_salvo_arg("--pack")), self.submit_pack,
+            is_dry_run=is_dry_run, use_abs_path=use_abs_path,
+        )
+
+    def submit_pack(self, directory, jobs):
+        max_parallel = self.get_salvo_arg("--max-parallel")
+        self.wait_for_capacity()
+        self.executor = self._build_executor(directory)
+        packed = PackedCommands(
+            [command for command, _ in jobs],
+            [os.path.join(job_info["script_args"][0], "Logs") for _, job_info in jobs],
+            max_parallel=int(max_parallel) if max_parallel is not None else None,
+        )
+        rich.print(f":package: [bold]Packing {len(jobs)} jobs into one[/bold]")
+        job = self.executor.submit(packed)
+        self.track(job)
+        for pack_idx, (_, job_info) in enumerate(jobs):
+            job_info["job"] = job
+            job_info["pack_idx"] = pack_idx
+
+    @staticmethod
+    def link_job_logs(job, experiment_directory):
+        logs = os.path.join(experiment_directory, "Logs")
+        os.makedirs(logs, exist_ok=True)
+        for path in (job.paths.submitted_pickle, job.paths.stdout, job.paths.stderr, job.paths.result_pickle):
+            link = os.path.join(logs, path.name)
+            if not os.path.lexists(link):
+                os.symlink(path, link)
+
+    def track(self, job):
+        # Submitted jobs are only kept around when they are needed for backpressure.
+        if self.get_salvo_arg("--max-in-flight") is not None or self.get_salvo_arg("--max-queued") is not None:
+            self.in_flight[job.job_id] = job
+
+    def wait_for_capacity(self, num_jobs=1):
+        """Blocks while submitting num_jobs more jobs would exceed --max-in-flight unfinished jobs or
+        --max-queued pending jobs, so large salvos do not flood the scheduler."""
+        max_in_flight = self.get_salvo_arg("--max-in-flight")
+        max_queued = self.get_salvo_arg("--max-queued")
+        if max_in_flight is None and max_queued is None:
+            return
+        while True:
+            self.in_flight = {job_id: job for job_id, job in self.in_flight.items() if not job.done()}
+            in_flight = len(self.in_flight)
+            queued = sum(job.state == "PENDING" for job in self.in_flight.values()) if max_queued is not None else 0
+            # A group bigger than the limit still goes out once nothing is in flight.
+            if (max_in_flight is None or in_flight == 0 or in_flight + num_jobs <= int(max_in_flight)) and (
+                max_queued is None or queued == 0 or queued + num_jobs <= int(max_queued)
+            ):
+                return
+            with rich.get_console().status(f"{in_flight} jobs in flight, {queued} queued. Waiting to launch..."):
+                time.sleep(BACKPRESSURE_INTERVAL)
+
     def launch(self, generator=None):
         # Launch the salvo!
         # Import the generator from the file
@@ -242,38 +367,85 @@ class Salvo(object):
             generator = self.get_generator()
         template_args = deepcopy(self.script_args)
 
-        launched_jobs = []
-        for job_idx, kwargs in enumerate(generator):
-            job_info = self.launch_one_job(
-                job_idx,
-                kwargs,
+        if self.in_salvo_arg_block("--pack"):
+            launched_jobs = self.launch_packed(
+                generator,
                 self.script_path,
                 template_args,
                 is_dry_run=self.is_dry_run,
                 use_abs_path=self.use_abs_path,
             )
-            launched_jobs.append(job_info)
-        # Store launched jobs if required
+        elif self.in_salvo_arg_block("--batch"):
+            launched_jobs = self.launch_batched(
+                generator,
+                self.script_path,
+                template_args,
+                is_dry_run=self.is_dry_run,
+                use_abs_path=self.use_abs_path,
+            )
+        else:
+            launched_jobs = (
+                self.launch_one_job(
+                    job_idx,
+                    kwargs,
+                    self.script_path,
+                    template_args,
+                    is_dry_run=self.is_dry_run,
+                    use_abs_path=self.use_abs_path,
+                )
+                for job_idx, kwargs in enumerate(generator)
+            )
+        # Store launched jobs if required, one entry as soon as each job is submitted
         log_path = self.get_salvo_arg("--log")
         if log_path is not None:
             rich.print(
-                f":scroll: [bold]Dumping a list of launched jobs at:[/bold] "
+                f":scroll: [bold]Logging launched jobs to:[/bold] "
                 f"[bold green]{log_path}[/bold green]"
             )
-            dump_yaml(launched_jobs, log_path)  # noqa
+        # Truncated once, so a rerun does not add to the jobs of the previous one.
+        log_file = open(log_path, "w") if log_path is not None else None
+        try:
+            for job_info in launched_jobs:
+                if log_file is not None:
+                    # Appended one element lists make up a single yaml list.
+                    job = job_info["job"]
+                    entry = dict(job_info, job=job.job_id if job is not None else None)
+                    log_file.write(dump_yaml([entry]))
+                    log_file.flush()
+        finally:
+            if log_file is not None:
+                log_file.close()
+
+    def nuke_one(self, job_spec):
+        rich.print(
+            f":boom: [bold]Nuking:[/bold] "
+            f"[bold blue]{job_spec['job_id']} / "
+            f"{job_spec.get('wandb_name', 'UNK')} / "
+            f"{job_spec.get('wandb_id', 'UNK')}[/bold blue]"
+        )
+        if not self.is_dry_run:
+            Job(job_spec["job_id"]).nuke()
 
     def nuke(self, generator=None):
         if generator is None:
             generator = self.get_generator()
         for job_spec in generator:
-            rich.print(
-                f":boom: [bold]Nuking:[/bold] "
-                f"[bold blue]{job_spec['job_id']} / "
-                f"{job_spec.get('wandb_name', 'UNK')} / "
-                f"{job_spec.get('wandb_id', 'UNK')}[/bold blue]"
-            )
-            if not self.is_dry_run:
-                Job(job_spec["job_id"]).nuke()
+            self.nuke_one(job_spec)
+
+    def nuke_stream(self, generator, wait=0):
+        """Nukes every job as soon as it is generated, and yields it again once wait seconds have passed."""
+        waiting = deque()
+        for job_spec in generator:
+            self.nuke_one(job_spec)
+            waiting.append((time.time() + wait, job_spec))
+            while waiting and waiting[0][0] <= time.time():
+                yield waiting.popleft()[1]
+        while waiting:
+            deadline, job_spec = waiting.popleft()
+            if deadline > time.time():
+                with rich.get_console().status(f"Waiting [bold]{int(deadline - time.time())}s[/bold] for launch..."):
+                    time.sleep(deadline - time.time())
+            yield job_spec
 
     def request_exit(self, generator=None):
         if generator is None:
@@ -295,16 +467,10 @@ class Salvo(object):
     def nuke_and_launch(self, generator=None):
         if generator is None:
             generator = self.get_generator()
-        generator = list(generator)
-        # First, nuke
-        self.nuke(generator)
-        rich.print("[red]-------------------[/red]")
-        if self.in_salvo_arg_block("--wait-before-launch"):
-            console = rich.get_console()
-            with console.status("Waiting [bold]60s[/bold] for launch..."):
-                time.sleep(60)
-        # Next, launch
-        self.launch(generator)
+        # Every job is nuked, then relaunched (after 60s with --wait-before-launch) while the generator is
+        # still producing the next ones.
+        wait = 60 if self.in_salvo_arg_block("--wait-before-launch") else 0
+        self.launch(self.nuke_stream(generator, wait=wait))
 
     def fire(self):
         if self.in_salvo_arg_block("--nuke"):
@@ -1,11 +1,60 @@
 #!/usr/bin/env python
 import os
 import sys
+import queue
+import shlex
 import click
+import subprocess
 import submitit
+from concurrent.futures import ThreadPoolExecutor
 from submitit.core.utils import CommandFunction
 
 
+class PackedCommands(object):
+    """Runs several commands in one job allocation, as a work queue. By default as many run at the same
+    time as there are GPUs (each gets its own CUDA_VISIBLE_DEVICES), or CPUs if there are none.
+
+    Each command writes its stdout, stderr and exit code to {log_dir}/packed.out, .err and .exit, so a
+    failing command only fails itself. Calling it returns the exit code of every command."""
+
+    def __init__(self, commands, log_dirs, max_parallel=None):
+        self.commands = commands
+        self.log_dirs = log_dirs
+        self.max_parallel = max_parallel
+
+    def __call__(self):
+        gpus = [gpu for gpu in os.environ.get("CUDA_VISIBLE_DEVICES", "").split(",") if gpu]
+        cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count()))
+        max_parallel = self.max_parallel or len(gpus) or cpus
+        slots = queue.Queue()
+        for slot in range(max_parallel):
+            slots.put(gpus[slot % len(gpus)] if gpus else None)
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            retcodes = list(executor.map(lambda i: self.run_one(i, slots), range(len(self.commands))))
+        print(f"{sum(retcode != 0 for retcode in retcodes)} of {len(retcodes)} packed commands failed: {retcodes}")
+        return retcodes
+
+    def run_one(self, i, slots):
+        command, log_dir = self.commands[i], self.log_dirs[i]
+        os.makedirs(log_dir, exist_ok=True)
+        env = dict(os.environ)
+        gpu = slots.get()
+        if gpu is not None:
+            env["CUDA_VISIBLE_DEVICES"] = gpu
+        try:
+            print(f"running: {command}", flush=True)
+            with open(os.path.join(log_dir, "packed.out"), "w") as out, open(os.path.join(log_dir, "packed.err"), "w") as err:
+                retcode = subprocess.run(command, stdout=out, stderr=err, env=env).returncode
+        except Exception as e:
+            print(f"{command} failed with {e}", flush=True)
+            retcode = -1
+        finally:
+            slots.put(gpu)
+        with open(os.path.join(log_dir, "packed.exit"), "w") as fp:
+            fp.write(f"{retcode}\n")
+        return retcode
+
+
 @click.command(
     context_settings=dict(ignore_unknown_options=True, allow_extra_args=True)
 )
@@ -14,7 +63,9 @@ from submitit.core.utils import CommandFunction
 @click.option("--mem_gb")
 @click.option("--cpus_per_task")
 @click.option("--slurm_gres")
-def main(train_script, experiment_dir, **kwargs):
+@click.option("--pack-file", help="Run one command per line of this file (arguments to train_script) in a single job.")
+@click.option("--max-parallel", type=int, help="Packed commands run at the same time (default: GPUs or CPUs).")
+def main(train_script, experiment_dir, pack_file=None, max_parallel=None, **kwargs):
 
     # create the submitit executor for creating and managing jobs
     ex = submitit.AutoExecutor(folder=os.path.join(experiment_dir, "Logs"))
@@ -30,6 +81,15 @@ def main(train_script, experiment_dir, **kwargs):
             slurm_partition=kwargs.get("slurm_partition") or "long",
             slurm_gres=kwargs.get("slurm_gres"),
         )
+    if pack_file is not None:
+        with open(pack_file, "r") as fp:
+            lines = [line for line in fp.read().splitlines() if line.strip()]
+        commands = [["python3", train_script] + shlex.split(line) for line in lines]
+        log_dirs = [os.path.join(experiment_dir, "Logs", f"pack-{i}") for i in range(len(commands))]
+        print(f"running {len(commands)} packed commands")
+        ex.submit(PackedCommands(commands, log_dirs, max_parallel=max_parallel))
+        return
+
     command = ["python3"] + sys.argv[1:]
     print(f"running: {command}")
 
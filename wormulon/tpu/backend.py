@@ -0,0 +1,158 @@
+import os
+import json
+import time
+from wormulon.utils import execute
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+
+try:
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+except ImportError:
+    AuthorizedSession = None
+
+GOOGLE_TPU_API = "https://tpu.googleapis.com"
+# Base URL of the Cloud TPU API. Point it at a local HTTP stand-in to test without GCP.
+TPU_API_ENDPOINT = os.environ.get("WORMULON_TPU_API_ENDPOINT", f"{GOOGLE_TPU_API}/v2alpha1")
+TPU_RUNTIME_VERSION = "tpu-vm-pt-1.10"
+# Seconds TPU creation is waited for, like the timeout on the gcloud create call.
+CREATE_TIMEOUT = 300
+SHUTDOWN_SCRIPT = ("#! /bin/bash\n"
+                   "pgrep -f python3 | xargs kill -SIGTERM\n"
+                   "while pgrep -f python3 > /dev/null; do sleep 1; done\n")
+
+
+class GcloudBackend(object):
+    """Manages TPUs by running gcloud."""
+
+    def list_nodes(self, zone):
+        command = f"gcloud compute tpus list --zone {zone} --format=json"
+        stdout, stderr, retcode = execute(command.split(), capture_output=True)
+        if retcode != 0:
+            raise Exception(f"Failed to list the TPUs in {zone}: {stderr}")
+        return json.loads(stdout or "[]")
+
+    def create_node(self, name, zone, network, subnet, netrange, acc_type, preemptible):
+        command = f"gcloud alpha compute tpus tpu-vm create {name} \
+          --zone {zone} \
+          --network {network} \
+          --subnetwork {subnet} \
+          --range {netrange} \
+          --accelerator-type {acc_type} \
+          --version {TPU_RUNTIME_VERSION} \
+           {'--preemptible' if preemptible else ''}"
+        command = command.split()
+        command.append("--metadata")
+        command.append("shutdown-script=\'#! /bin/bash;"
+                       ""
+                       " pgrep -f python3 | xargs kill -SIGTERM;"
+                       " while pgrep -f python3 > /dev/null;"
+                       " do sleep 1; "
+                       "done; \'")
+        stdout, stderr, retcode = execute(command, capture_output=True, timeout=CREATE_TIMEOUT)
+        if retcode == 0:
+            return stdout, retcode
+        return stderr, retcode
+
+    def delete_node(self, name, zone):
+        return execute(f"gcloud alpha compute tpus tpu-vm delete {name} --zone {zone} --async --quiet".split())
+
+
+def uses_google_api(endpoint):
+    return endpoint.startswith(GOOGLE_TPU_API)
+
+
+class RestBackend(object):
+    """Manages TPUs through the Cloud TPU REST API, over one pooled and authenticated HTTP session.
+    Responses are the API's JSON nodes, the same as `gcloud ... --format=json` gives."""
+
+    def __init__(self, project=None, endpoint=TPU_API_ENDPOINT, session=None):
+        if session is None:
+            if uses_google_api(endpoint):
+                credentials, default_project = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+                session = AuthorizedSession(credentials)
+                project = project or default_project
+            else:
+                # A local stand-in of the API needs no credentials.
+                session = requests.Session()
+            for prefix in ("https://", "http://"):
+                session.mount(prefix, HTTPAdapter(pool_connections=8, pool_maxsize=8))
+        self.project = project or os.environ.get("WORMULON_TPU_PROJECT")
+        if not self.project:
+            # Without one, every request would go to projects/None and fail.
+            raise ValueError("No GCP project found, set WORMULON_TPU_PROJECT")
+        self.endpoint = endpoint.rstrip("/")
+        self.session = session
+
+    def nodes_url(self, zone):
+        return f"{self.endpoint}/projects/{self.project}/locations/{zone}/nodes"
+
+    def list_nodes(self, zone):
+        nodes, params = [], {}
+        while True:
+            response = self.session.get(self.nodes_url(zone), params=params)
+            response.raise_for_status()
+            page = response.json()
+            nodes.extend(page.get("nodes", []))
+            if not page.get("nextPageToken"):
+                return nodes
+            params = {"pageToken": page["nextPageToken"]}
+
+    def wait_for(self, operation, timeout=CREATE_TIMEOUT):
+        deadline = time.time() + timeout
+        while not operation.get("done"):
+            if time.time() > deadline:
+                return None
+            time.sleep(5)
+            response = self.session.get(f"{self.endpoint}/{operation['name']}")
+            response.raise_for_status()
+            operation = response.json()
+        return operation
+
+    def create_node(self, name, zone, network, subnet, netrange, acc_type, preemptible):
+        """Creates a TPU and waits for it. Returns (message, retcode) like GcloudBackend.create_node."""
+        body = {
+            "acceleratorType": acc_type,
+            "runtimeVersion": TPU_RUNTIME_VERSION,
+            "cidrBlock": netrange,
+            "networkConfig": {"network": network, "subnetwork": subnet, "enableExternalIps": True},
+            "schedulingConfig": {"preemptible": preemptible},
+            "metadata": {"shutdown-script": SHUTDOWN_SCRIPT},
+        }
+        response = self.session.post(self.nodes_url(zone), params={"nodeId": name}, json=body)
+        if not response.ok:
+            return response.text, 1
+        operation = self.wait_for(response.json())
+        if operation is None:
+            return f"Timed out creating {name}", 1
+        if "error" in operation:
+            return json.dumps(operation["error"]), 1
+        return json.dumps(operation.get("response", {})), 0
+
+    def delete_node(self, name, zone):
+        response = self.session.delete(f"{self.nodes_url(zone)}/{name}")
+        return ("", response.text, 0 if response.ok else 1)
+
+
+_backend = None
+_backend_pid = None
+
+
+def get_backend():
+    """Returns the TPU backend of this process: RestBackend unless WORMULON_TPU_BACKEND=gcloud, or if
+    requests, google-auth, credentials or a project are missing, in which case gcloud is used."""
+    global _backend, _backend_pid
+    if _backend is None or _backend_pid != os.getpid():
+        _backend = GcloudBackend()
+        has_client = requests is not None and (AuthorizedSession is not None or not uses_google_api(TPU_API_ENDPOINT))
+        if os.environ.get("WORMULON_TPU_BACKEND", "rest") == "rest" and has_client:
+            try:
+                _backend = RestBackend()
+            except Exception as e:
+                print(f"Falling back to gcloud for TPU management: {e}")
+        _backend_pid = os.getpid()
+    return _backend
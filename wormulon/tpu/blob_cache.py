@@ -0,0 +1,61 @@
+import os
+import fcntl
+import hashlib
+
+# Default upper bound on the total size of the files in a BlobCache.
+BLOB_CACHE_SIZE = 64 * 1024 ** 3
+
+
+class BlobCache(object):
+    """Content-addressed on-disk cache of GCS blobs, keyed on bucket, blob name and generation.
+
+    Every entry has a lock file, so when several processes (e.g. the xmp workers) ask for the same
+    blob, one of them downloads it and the others wait and reuse the file. Once the cache grows past
+    max_bytes, the least recently used entries are evicted."""
+
+    def __init__(self, directory, max_bytes=BLOB_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, blob):
+        return hashlib.sha256(f"{blob.bucket.name}/{blob.name}#{blob.generation}".encode()).hexdigest()
+
+    def get(self, blob):
+        """Returns the path of a local copy of blob, downloading it unless it is already cached."""
+        path = os.path.join(self.directory, self.key(blob))
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(path):
+                    os.utime(path)
+                else:
+                    blob.download_to_filename(f"{path}.part", if_generation_match=blob.generation)
+                    os.replace(f"{path}.part", path)
+                    self.evict(keep=path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return path
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith((".lock", ".part")):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until the cache fits in max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
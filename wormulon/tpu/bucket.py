@@ -1,37 +1,181 @@
 import io
+import os
 import operator
+import threading
 import time
+import torch
 from datetime import datetime
 from dateutil import parser
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from google.api_core.exceptions import NotModified
 from google.cloud import storage
-from wormulon.utils import JobState, load_yaml
+from requests.adapters import HTTPAdapter
+from wormulon.utils import JobState, load_yaml, dump_yaml
 from wormulon.tpu.fncall import FunctionCall
-from wormulon.train_state import TrainState
+from wormulon.tpu.blob_cache import BlobCache
+from wormulon.train_state import TrainState, HostTrainState, to_host, MANIFEST_NAME, SHARD_SUFFIX, MAX_SHARD_SIZE
 Experiment = namedtuple("Experiment", ["experiment_name", "dataset_name", "step", "blob"])
+CachedJobState = namedtuple("CachedJobState", ["generation", "metageneration", "jobstate"])
+
+# Size of the HTTP connection pool shared by every request made through a Bucket.
+HTTP_POOL_SIZE = 32
+# Number of jobstate blobs downloaded concurrently by list_jobs.
+JOBSTATE_WORKERS = 16
+
+# Chunk size of resumable checkpoint uploads and ranged checkpoint reads. Must be a multiple of 256 KiB.
+CHECKPOINT_CHUNK_SIZE = 32 * 1024 * 1024
+# Number of checkpoint shards transferred concurrently.
+CHECKPOINT_WORKERS = 8
+# Maximum number of parsed jobstates kept in memory by the JobStateCache.
+JOBSTATE_CACHE_SIZE = 4096
+
+
+class JobStateCache(object):
+    """LRU cache of parsed jobstate blobs. Entries are keyed on (bucket, blob name) and are only
+    valid for the GCS generation and metageneration they were read at."""
+
+    def __init__(self, maxsize=JOBSTATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # A forked child could inherit the lock while a thread of its parent holds it.
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    def get(self, key, generation=None, metageneration=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if generation is not None and (entry.generation, entry.metageneration) != (generation, metageneration):
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, generation, metageneration, jobstate):
+        if generation is None:
+            return
+        with self._lock:
+            self._entries[key] = CachedJobState(generation, metageneration, jobstate)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
 
 class Bucket(object):
-    def __init__(self, name):
+    # Shared by all Bucket instances, since the nanny builds one Bucket per job.
+    jobstate_cache = JobStateCache()
+
+    def __init__(self, name, cache_dir=None):
         self.name = name
         self.last_touch = time.time()
+        # Reads go through an on-disk BlobCache if a cache directory is given or set in the environment.
+        cache_dir = cache_dir or os.environ.get("WORMULON_BLOB_CACHE")
+        self.cache = BlobCache(cache_dir) if cache_dir else None
+        self._client = None
+        self._bucket = None
+        self._pid = None
+
+    def __getstate__(self):
+        # Clients hold sockets and credentials, so they are rebuilt after unpickling.
+        state = self.__dict__.copy()
+        state.update(_client=None, _bucket=None, _pid=None)
+        return state
+
+    def __setstate__(self, state):
+        # Buckets pickled before clients were cached (e.g. in old job pickles) lack these attributes.
+        self.__dict__.update({"_client": None, "_bucket": None, "_pid": None, "cache": None, **state})
+
+    @property
+    def client(self):
+        """A storage client that is created once per process and reuses its HTTP connections.
+        A forked child (e.g. a multiprocessing.Process) sees a different pid and builds its own."""
+        if self._client is None or self._pid != os.getpid():
+            client = storage.Client()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            client._http.mount("https://", adapter)
+            self._client = client
+            self._bucket = client.bucket(self.name)
+            self._pid = os.getpid()
+        return self._client
 
-    def list(self, filter: str):
-        storage_client = storage.Client()
-        blobs = storage_client.list_blobs(self.name)
+    @property
+    def bucket(self):
+        """Handle on the GCS bucket. Does not make a request, unlike client.get_bucket."""
+        if self._bucket is None or self._pid != os.getpid():
+            self.client
+        return self._bucket
+
+    @staticmethod
+    def normalize_path(path):
+        if path.startswith("gs://"):
+            path = path[5:]
+        if path.startswith("/"):
+            path = path[1:]
+        return path
+
+    def list(self, filter: str = None, prefix: str = None, match_glob: str = None, delimiter: str = None):
+        """Lists blobs in the bucket. `prefix`, `match_glob` and `delimiter` are evaluated by GCS,
+        so only matching blobs are sent back; `filter` is an additional substring match done locally."""
+        if prefix:
+            prefix = self.normalize_path(prefix)
+        blobs = self.client.list_blobs(self.name, prefix=prefix, match_glob=match_glob, delimiter=delimiter)
         if filter:
-            blobs = [blob for blob in blobs if filter in blob.name]
-        return blobs
+            return [blob for blob in blobs if filter in blob.name]
+        return list(blobs)
 
-    def list_jobs(self, filters = []):
-        results = []
-        blobs = self.list(filter="jobstate")
-        for blob in blobs:
-            bytes = blob.download_as_bytes()
-            buffer = io.BytesIO(bytes)
-            jobstate = load_yaml(buffer.getvalue())
+    def fetch_jobstates(self, blobs, max_workers=JOBSTATE_WORKERS):
+        """Downloads and parses jobstate blobs concurrently. Returns a {job_id: jobstate} dict,
+        in the same order as blobs."""
+        def fetch(blob):
+            jobstate = self.jobstate_from_blob(blob)
             jobstate['state'] = JobState(jobstate.get("state")).name
             jobstate['blob'] = blob
+            return jobstate
+
+        blobs = list(blobs)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(blobs)))) as executor:
+            jobstates = list(executor.map(fetch, blobs))
+        return {os.path.basename(os.path.dirname(blob.name)): jobstate for blob, jobstate in zip(blobs, jobstates)}
+
+    def jobstate_from_blob(self, blob):
+        """Parses a jobstate blob whose metadata has already been fetched (e.g. by a listing or
+        get_blob). Only downloads the contents if the blob changed since it was last read."""
+        key = (self.name, blob.name)
+        entry = self.jobstate_cache.get(key, blob.generation, blob.metageneration)
+        if entry is None:
+            jobstate = load_yaml(blob.download_as_bytes())
+            self.jobstate_cache.put(key, blob.generation, blob.metageneration, jobstate)
+        else:
+            jobstate = entry.jobstate
+        return jobstate.copy()
 
+    def read_jobstate(self, path):
+        """Reads the jobstate at path. When a cached copy exists, this is a conditional GET that
+        only transfers the blob if its generation changed."""
+        path = self.normalize_path(path)
+        key = (self.name, path)
+        entry = self.jobstate_cache.get(key)
+        blob = self.bucket.blob(path)
+        try:
+            if entry is None:
+                data = blob.download_as_bytes()
+            else:
+                data = blob.download_as_bytes(if_generation_not_match=entry.generation)
+        except NotModified:
+            return entry.jobstate.copy()
+        jobstate = load_yaml(data)
+        self.jobstate_cache.put(key, blob.generation, blob.metageneration, jobstate)
+        return jobstate.copy()
+
+    def list_jobs(self, filters = [], prefix=None, max_workers=JOBSTATE_WORKERS):
+        results = []
+        blobs = self.list(prefix=prefix, match_glob="**/jobstate.yml")
+        for jobstate in self.fetch_jobstates(blobs, max_workers=max_workers).values():
             if not filters:
                 results.append(jobstate)
             for filter in filters:
@@ -39,21 +183,29 @@ class Bucket(object):
                     results.append(jobstate)
         return results
 
-    def list_experiments(self):
-
-        blobs = self.list("trainstate")
+    def list_checkpoints(self, prefix=None, blobs=None):
+        """Groups the checkpoints under prefix by experiment and dataset, each group sorted by step."""
+        if blobs is None:
+            blobs = self.list(prefix=prefix, match_glob="**trainstate**")
         experiments = defaultdict(list)
         for blob in blobs:
-            step_num = int(blob.name.split("-")[-1].split(".")[0])
-            dataset_name = blob.name.split("/")[-1].split("-")[0]
-            exp_name = blob.name.split("/")[1]
+            path = self.checkpoint_path(blob)
+            if path is None:
+                continue
+            step_num = int(path.split("-")[-1].split(".")[0])
+            dataset_name = path.split("/")[-1].split("-")[0]
+            exp_name = path.split("/")[1]
             experiments[f"{exp_name}-{dataset_name}"].append(Experiment(exp_name, dataset_name, step_num, blob))
+        for exp in experiments.values():
+            exp.sort(key=operator.attrgetter("step"))
+        return experiments
 
+    def list_experiments(self, prefix=None):
+
+        experiments = self.list_checkpoints(prefix)
         last_checkpoints = {}
         for exp_id in experiments.keys():
-            exp = experiments[exp_id]
-            exp.sort(key=operator.attrgetter("step"))
-            last_checkpoints[exp_id] = exp[-1]
+            last_checkpoints[exp_id] = experiments[exp_id][-1]
 
         print("Found the following experiments:\n")
         for exp_id, exp in last_checkpoints.items():
@@ -61,17 +213,27 @@ class Bucket(object):
             print(f"{exp_id}: {exp.blob.name}, updated on {updated}")
         return last_checkpoints
 
-    def get_latest_trainstate(self, experiment_directory):
-        blobs = self.list(filter=f"{experiment_directory}/trainstate")
+    @staticmethod
+    def checkpoint_path(blob):
+        """Path of the checkpoint a blob belongs to: the blob itself, or the directory of a sharded
+        checkpoint for its manifest. Returns None for shards."""
+        if blob.name.endswith(SHARD_SUFFIX):
+            return None
+        if blob.name.endswith(f"/{MANIFEST_NAME}"):
+            return os.path.dirname(blob.name)
+        return blob.name
+
+    def get_latest_trainstate(self, experiment_directory, groups=None):
+        """Loads the most recent checkpoint. For sharded checkpoints, only the state dicts in groups
+        are downloaded right away; the others are fetched when first used."""
+        blobs = [blob for blob in self.list(prefix=f"{experiment_directory}/trainstate") if self.checkpoint_path(blob)]
         blobs.sort(key=operator.attrgetter("updated"))
-        bytes = blobs[-1].download_as_bytes()
-        buffer = io.BytesIO(bytes)
-        trainstate = TrainState.deserialize(buffer)
-        return trainstate
+        if blobs[-1].name.endswith(f"/{MANIFEST_NAME}"):
+            return self.download_sharded_trainstate(self.checkpoint_path(blobs[-1]), groups=groups)
+        return self.download_trainstate(blobs[-1].name)
 
     def get_latest_fncall(self, experiment_directory):
-        blobs = self.list(filter=f"{experiment_directory}")
-        fncalls = list(filter(lambda x: x.name.endswith("function_call.pkl"), blobs))
+        fncalls = self.list(prefix=f"{experiment_directory}/", match_glob="**/function_call.pkl")
         fncalls.sort(key=operator.attrgetter("updated"))
         bytes = fncalls[-1].download_as_bytes()
         buffer = io.BytesIO(bytes)
@@ -86,8 +248,7 @@ class Bucket(object):
         :param folder: Folder name to be deleted
         :return: returns nothing
         """
-        cloud_storage_client = storage.Client()
-        bucket = cloud_storage_client.bucket(bucket_name)
+        bucket = self.client.bucket(bucket_name)
         try:
             bucket.delete_blobs(blobs=list(bucket.list_blobs(prefix=folder)))
         except Exception as e:
@@ -100,50 +261,142 @@ class Bucket(object):
             return
         print(f"Uploading to {self.name}/{path}")
 
-        client = storage.Client()
-        blob = storage.blob.Blob.from_string("gs://" + self.name + "/" + path)
-        blob.bucket._client = client
+        blob = self.bucket.blob(path)
         blob.upload_from_string(data)
 
+    def open(self, path, mode="rb", chunk_size=CHECKPOINT_CHUNK_SIZE, metadata=None):
+        """Opens a file-like object on a blob. Reads are ranged requests of chunk_size bytes and
+        writes go through a resumable upload, so at most one chunk is held in memory."""
+        blob = self.bucket.blob(self.normalize_path(path), chunk_size=chunk_size)
+        if "w" in mode:
+            blob.metadata = metadata
+            # torch.save flushes its buffer when done, which a BlobWriter refuses unless told to ignore it.
+            return blob.open(mode, ignore_flush=True)
+        return blob.open(mode)
+
+    def upload_trainstate(self, path, trainstate, chunk_size=CHECKPOINT_CHUNK_SIZE, metadata=None):
+        """Streams a TrainState to GCS without serializing it to memory first. metadata (e.g. eval
+        metrics for retention.KeepBest) is stored as custom blob metadata."""
+        if not trainstate.is_writer:
+            # Every ordinal has to take part in xm.save, but only the master writes anything.
+            trainstate.save(io.BytesIO())
+            return
+        print(f"Uploading to {self.name}/{path}")
+        with self.open(path, "wb", chunk_size=chunk_size, metadata=metadata) as fp:
+            trainstate.save(fp)
+
+    def upload_delta_trainstate(self, path, trainstate, base_path, base_hashes, chunk_size=CHECKPOINT_CHUNK_SIZE,
+                                metadata=None):
+        """Uploads a delta checkpoint holding only the tensors that changed since the checkpoint at base_path.
+        The base is also recorded in the blob metadata. Returns the tensor hashes of trainstate, or None
+        on the ordinals that do not write checkpoints."""
+        if not trainstate.is_writer:
+            return None
+        states, hashes = trainstate.delta(base_path, base_hashes)
+        if not isinstance(trainstate, HostTrainState):
+            # Saved with torch.save, so XLA tensors have to be copied to the host first.
+            states = to_host(states)
+        print(f"Uploading delta against {base_path} to {self.name}/{path}")
+        with self.open(path, "wb", chunk_size=chunk_size, metadata={**(metadata or {}), "base": self.normalize_path(base_path)}) as fp:
+            torch.save(states, fp)
+        return hashes
+
+    def open_cached(self, path, chunk_size=CHECKPOINT_CHUNK_SIZE):
+        """Opens a blob for reading. With a blob cache, this is the local copy (downloaded once per
+        generation and shared between processes), otherwise a chunked reader on the blob."""
+        if self.cache is None:
+            return self.open(path, "rb", chunk_size=chunk_size)
+        blob = self.get_blob(path)
+        if blob is None:
+            raise FileNotFoundError(f"gs://{self.name}/{path}")
+        return open(self.cache.get(blob), "rb")
+
+    def download_trainstate(self, path, chunk_size=CHECKPOINT_CHUNK_SIZE):
+        """Streams a TrainState from GCS without downloading it to memory first. Delta checkpoints
+        are merged with their base checkpoint."""
+        with self.open_cached(path, chunk_size=chunk_size) as fp:
+            return TrainState.deserialize(fp, base_loader=self.download_trainstate)
+
+    def upload_sharded_trainstate(self, path, trainstate, max_shard_size=MAX_SHARD_SIZE, max_workers=CHECKPOINT_WORKERS,
+                                  metadata=None):
+        """Uploads a TrainState as a directory of concurrently uploaded shards. The manifest goes up last,
+        so a sharded checkpoint is never picked up before all of its shards exist."""
+        if not trainstate.is_writer:
+            return
+        print(f"Uploading shards to {self.name}/{path}")
+        manifest, shards = trainstate.shards(max_shard_size)
+
+        def upload(name):
+            with self.open(f"{path}/{name}", "wb") as fp:
+                torch.save(shards[name], fp)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(upload, shards))
+        blob = self.bucket.blob(f"{path}/{MANIFEST_NAME}")
+        blob.metadata = metadata
+        blob.upload_from_string(dump_yaml(manifest))
+
+    def download_shards(self, path, shard_names, max_workers=CHECKPOINT_WORKERS):
+        """Downloads and loads shards of the sharded checkpoint at path concurrently."""
+        def download(name):
+            with self.open_cached(f"{path}/{name}") as fp:
+                return torch.load(fp)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(shard_names)))) as executor:
+            return list(executor.map(download, shard_names))
+
+    def download_sharded_trainstate(self, path, groups=None):
+        manifest = load_yaml(self.download(f"{path}/{MANIFEST_NAME}").getvalue())
+        meta, = self.download_shards(path, [f"meta{SHARD_SUFFIX}"])
+        return TrainState.from_shards(manifest, meta, partial(self.download_shards, path), groups=groups)
+
     def download(self, path):
         blob = self.get_blob(path)
+        if self.cache is not None:
+            with open(self.cache.get(blob), "rb") as fp:
+                return io.BytesIO(fp.read())
         bytes = blob.download_as_bytes()
         buffer = io.BytesIO(bytes)
         return buffer
 
     def get_blob(self, path):
         """gets a blob from GCS"""
-        client = storage.Client()
-        bucket = client.get_bucket(self.name)
-        if path.startswith("gs://"):
-            path = path[5:]
+        path = self.normalize_path(path)
         if path.endswith("/"):
             path = path[:-1]
-        if path.startswith("/"):
-            path = path[1:]
-        blob = bucket.get_blob(path)
+        blob = self.bucket.get_blob(path)
         return blob
 
     def exists(self, path):
         """Downloads a file from GCS to local directory"""
-        client = storage.Client()
-        bucket = client.get_bucket(self.name)
-        return bucket.blob(path).exists()
+        return self.bucket.blob(path).exists()
 
     def delete(self, path):
-        client = storage.Client()
-        bucket = client.get_bucket(self.name)
         try:
-            bucket.blob(path).delete()
+            self.bucket.blob(path).delete()
         except Exception:
             pass
 
     def delete_all(self, path):
-        client = storage.Client()
-        blobs = client.list_blobs(self.name, prefix=path)
+        blobs = self.client.list_blobs(self.name, prefix=path)
         for blob in blobs:
             blob.delete()
 
+    def delete_blobs(self, names, max_workers=CHECKPOINT_WORKERS, batch_size=100):
+        """Deletes blobs using GCS batch requests of up to batch_size deletions, several batches at a time.
+        Blobs that are already gone are ignored."""
+        def delete(chunk):
+            # A client tracks one batch at a time, so every batch gets its own client.
+            client = storage.Client()
+            bucket = client.bucket(self.name)
+            with client.batch(raise_exception=False):
+                for name in chunk:
+                    bucket.delete_blob(name)
+
+        chunks = [names[idx:idx + batch_size] for idx in range(0, len(names), batch_size)]
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+            list(executor.map(delete, chunks))
+
     def touch(self, path):
         if time.time() - self.last_touch > 5:
             self.last_touch = time.time()
@@ -0,0 +1,101 @@
+import threading
+import weakref
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+
+# Every AsyncCheckpointer in this process, so that they can all be flushed on shutdown.
+_checkpointers = weakref.WeakSet()
+
+
+class AsyncCheckpointer(object):
+    """Uploads TrainState checkpoints in the background. save() only blocks while the state is copied
+    to host memory, and while max_in_flight earlier checkpoints are still uploading.
+
+    With delta=True, only every full_every-th checkpoint is a full one. The ones in between only
+    hold the tensors that changed since the last full checkpoint."""
+
+    def __init__(self, bucket, max_in_flight=1, sharded=False, delta=False, full_every=10):
+        if sharded and delta:
+            raise ValueError("Delta checkpoints can not be sharded.")
+        self.bucket = bucket
+        self.sharded = sharded
+        self.delta = delta
+        self.full_every = full_every
+        self._saves = 0
+        # Future of the last full checkpoint, resolving to its (path, tensor hashes).
+        self._base = None
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._pending = set()
+        self._lock = threading.Lock()
+        _checkpointers.add(self)
+
+    def save(self, path, trainstate, metadata=None):
+        """Snapshots trainstate and queues its upload to path. Returns a future, or None on the
+        ordinals that do not write checkpoints. metadata is stored as custom blob metadata."""
+        if not trainstate.is_writer:
+            return None
+        self._slots.acquire()
+        try:
+            snapshot = trainstate.to_host()
+            if self.delta and not self._needs_full_checkpoint():
+                future = self._executor.submit(self._upload_delta, path, snapshot, self._base, metadata)
+            else:
+                future = self._executor.submit(self._upload, path, snapshot, metadata)
+                if self.delta:
+                    self._base = future
+            self._saves += 1
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _needs_full_checkpoint(self):
+        if self._base is None or self._saves % self.full_every == 0:
+            return True
+        return self._base.done() and self._base.exception() is not None
+
+    def _upload(self, path, trainstate, metadata=None):
+        try:
+            if self.sharded:
+                self.bucket.upload_sharded_trainstate(path, trainstate, metadata=metadata)
+            else:
+                self.bucket.upload_trainstate(path, trainstate, metadata=metadata)
+            if self.delta:
+                return path, trainstate.tensor_hashes()
+        finally:
+            self._slots.release()
+
+    def _upload_delta(self, path, trainstate, base, metadata=None):
+        try:
+            base_path, base_hashes = base.result()
+            self.bucket.upload_delta_trainstate(path, trainstate, base_path, base_hashes, metadata=metadata)
+        finally:
+            self._slots.release()
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        if future.exception() is not None:
+            print(f"Checkpoint upload failed: {future.exception()}", flush=True)
+
+    def wait(self, timeout=None):
+        """Blocks until all queued checkpoints are uploaded. Returns False if timeout ran out first."""
+        with self._lock:
+            pending = set(self._pending)
+        _, not_done = futures.wait(pending, timeout=timeout)
+        return not not_done
+
+    def close(self, timeout=None):
+        done = self.wait(timeout)
+        self._executor.shutdown(wait=False)
+        _checkpointers.discard(self)
+        return done
+
+
+def wait_for_checkpoints(timeout=None):
+    """Flushes every AsyncCheckpointer of this process, e.g. before exiting on preemption."""
+    return all([checkpointer.wait(timeout) for checkpointer in list(_checkpointers)])
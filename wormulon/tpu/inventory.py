@@ -0,0 +1,76 @@
+import os
+import time
+import threading
+from collections import namedtuple
+from wormulon.tpu.backend import get_backend
+
+TPUInfo = namedtuple("TPUInfo", ["name", "state", "ip_addresses"])
+
+# Seconds a zone listing is reused before the TPU backend is asked again.
+INVENTORY_TTL = 30
+
+
+class TPUInventory(object):
+    """The TPUs of one zone, fetched with a single list call and reused for `ttl` seconds.
+    Call invalidate() after creating or deleting a TPU so the next lookup sees the change."""
+
+    def __init__(self, zone, ttl=INVENTORY_TTL):
+        self.zone = zone
+        self.ttl = ttl
+        self._tpus = dict()
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        # The lock is only held to swap in the new listing, never during the call to the backend.
+        try:
+            nodes = get_backend().list_nodes(self.zone)
+        except Exception as e:
+            # Keep serving the last listing, and try again on the next lookup.
+            print(f"Failed to list the TPUs in {self.zone}: {e}")
+            return self._tpus
+        tpus = dict()
+        for node in nodes:
+            name = node["name"].split("/")[-1]
+            ip_addresses = [endpoint.get("ipAddress") for endpoint in node.get("networkEndpoints", [])]
+            tpus[name] = TPUInfo(name, node.get("state"), ip_addresses)
+        with self._lock:
+            self._tpus = tpus
+            self._fetched_at = time.time()
+        return tpus
+
+    @property
+    def tpus(self):
+        with self._lock:
+            stale = self._fetched_at is None or time.time() - self._fetched_at > self.ttl
+        if stale:
+            return self.refresh()
+        return self._tpus
+
+    def invalidate(self):
+        with self._lock:
+            self._fetched_at = None
+
+    def get(self, name):
+        return self.tpus.get(name)
+
+    @property
+    def names(self):
+        return set(self.tpus.keys())
+
+    @property
+    def ready(self):
+        return {name for name, tpu in self.tpus.items() if tpu.state == "READY"}
+
+
+_inventories = dict()
+# A forked process (e.g. a job launched by the nanny) could inherit a lock held by a thread of its parent,
+# so it starts with fresh inventories.
+os.register_at_fork(after_in_child=_inventories.clear)
+
+
+def get_inventory(zone):
+    """Returns the TPUInventory of a zone, shared by every TPU and TPUManager in the process."""
+    if zone not in _inventories:
+        _inventories[zone] = TPUInventory(zone)
+    return _inventories[zone]
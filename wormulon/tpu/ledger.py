@@ -0,0 +1,83 @@
+import os
+import time
+import socket
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from wormulon.utils import load_yaml, dump_yaml
+
+# Folder of the bucket holding one lease object per TPU name.
+LEDGER_PREFIX = "tpu-ledger"
+# Seconds a claim holds unless it is renewed. Long enough to create and set up a TPU.
+LEASE_DURATION = 1800
+
+
+def default_owner():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class AllocationLedger(object):
+    """Leases on TPU names, shared by every scheduler through the bucket.
+
+    Each name has one lease object, and every write to it is conditional on the generation that was
+    read (0 when the object does not exist yet), so when several schedulers claim the same name exactly
+    one write succeeds. The objects are never deleted: a released lease just expires, so the highest
+    number ever handed out is known without listing the TPUs."""
+
+    def __init__(self, bucket, project, owner=None, lease_duration=LEASE_DURATION):
+        self.bucket = bucket
+        self.project = project
+        self.owner = owner or default_owner()
+        self.lease_duration = lease_duration
+
+    def path(self, name):
+        return f"{LEDGER_PREFIX}/{name}.yml"
+
+    def read(self, name):
+        """Returns (generation, lease) of a name, with generation 0 if it was never claimed."""
+        blob = self.bucket.get_blob(self.path(name))
+        if blob is None:
+            return 0, None
+        try:
+            return blob.generation, load_yaml(blob.download_as_text(if_generation_match=blob.generation))
+        except (NotFound, PreconditionFailed):
+            # Changed since we listed it, so someone else is claiming it right now.
+            return None, None
+
+    def write(self, name, generation, expires):
+        blob = self.bucket.bucket.blob(self.path(name))
+        try:
+            blob.upload_from_string(dump_yaml({"owner": self.owner, "expires": expires}), if_generation_match=generation)
+            return True
+        except PreconditionFailed:
+            return False
+
+    def claim(self, name):
+        """Leases name to this owner. Returns False if someone else holds an unexpired lease on it or
+        claimed it at the same time. Claiming a name this owner already holds renews the lease."""
+        generation, lease = self.read(name)
+        if generation is None:
+            return False
+        if lease is not None and lease.get("owner") != self.owner and lease.get("expires", 0) > time.time():
+            return False
+        return self.write(name, generation, time.time() + self.lease_duration)
+
+    def release(self, name):
+        generation, lease = self.read(name)
+        if generation and lease is not None and lease.get("owner") == self.owner:
+            self.write(name, generation, 0)
+
+    def claimed_names(self):
+        """Every name ever claimed, whether its lease expired or not."""
+        return {os.path.splitext(os.path.basename(blob.name))[0] for blob in self.bucket.list(prefix=LEDGER_PREFIX)}
+
+    def claim_new_name(self, taken=()):
+        """Claims the first unclaimed `{project}-{i}` after every name in the ledger and in taken."""
+        ids = [-1]
+        for name in self.claimed_names() | set(taken):
+            try:
+                ids.append(int(name.split("-")[-1]))
+            except ValueError:
+                pass
+        i = max(ids) + 1
+        while not self.claim(f"{self.project}-{i}"):
+            i += 1
+        return f"{self.project}-{i}"
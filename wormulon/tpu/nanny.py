@@ -11,20 +11,58 @@ import time
 import pickle
 import signal
 import click
+import heapq
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process
 from collections import defaultdict
 from wormulon.tpu.tpu_manager import TPUManager
-from wormulon.tpu.tpu_job import TPUJob
-from wormulon.utils import JobState
+from wormulon.tpu.tpu_job import TPUJob, read_job_header
+from wormulon.tpu.retention import RetentionTask
+from wormulon.tpu.utils import retention_policies
+from wormulon.utils import JobState, dump_yaml, load_yaml
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import PatternMatchingEventHandler
+except ImportError:
+    Observer = None
+
+# Seconds between checks of a job that was just launched or whose state we don't know yet.
+CHECK_INTERVAL = 5
+# Healthy jobs are checked less and less often, up to this many seconds apart. This has to stay
+# well below the 300 s heartbeat timeout of TPUJob.is_alive.
+MAX_CHECK_INTERVAL = 60
+# Seconds between full rescans of the experiment directory. Without watchdog, this is the only
+# way new jobs are found.
+DISCOVERY_INTERVAL = 60 if Observer is not None else CHECK_INTERVAL
+# Maximum number of blocking gcloud / GCS calls the AsyncNanny runs at the same time.
+BLOCKING_CALL_WORKERS = 32
+# Seconds after which the AsyncNanny stops waiting for a blocking call.
+BLOCKING_CALL_TIMEOUT = 300
+
 
 class Nanny:
 
-    def __init__(self, experiment_directory):
+    def __init__(self, experiment_directory, retention=None):
         super(Nanny, self).__init__()
         self.jobs = dict()
         self.managers = dict()
         self.job_procs = dict()
+        # TPUs being created for jobs that are waiting to be launched, by job id.
+        self.provisioning = dict()
         self.experiment_directory = experiment_directory
+        # Optional RetentionTask that garbage collects the checkpoints of the jobs we find.
+        self.retention = retention
+        # Heap of (deadline, job_id): when each job is due for its next check.
+        self.schedule = []
+        self.check_intervals = dict()
+        # Set when the job pickles may have changed, to wake up the scheduler and rediscover jobs.
+        self.jobs_changed = threading.Event()
+        self.observer = None
+        # Index of the job pickles: {path: {"mtime", "size", "job_id"}}, kept on disk between runs.
+        self.job_index = self.load_job_index()
         signal.signal(signal.SIGINT, self.exit_gracefully)
 
     def write_to_logfile(self, message, verbose=False):
@@ -35,19 +73,78 @@ class Nanny:
         with open("experiments/nanny-log.txt", "a") as fp:
             fp.write(f"{message}\n")
 
+    @property
+    def job_index_path(self):
+        return os.path.join(self.experiment_directory, ".nanny-job-index.yml")
+
+    def load_job_index(self):
+        try:
+            with open(self.job_index_path, "r") as fp:
+                return dict(load_yaml(fp.read()) or {})
+        except (FileNotFoundError, OSError):
+            return dict()
+
+    def save_job_index(self):
+        try:
+            with open(self.job_index_path, "w") as fp:
+                fp.write(dump_yaml({path: dict(entry) for path, entry in self.job_index.items()}))
+        except OSError as e:
+            self.write_to_logfile(f"Could not save the job index: {e}")
+
     def find_jobs(self):
-        """ Looks through the experiments directory and finds jobs. Adds them to dictionary if they aren't already there."""
-        for job_path in glob.glob(f"{self.experiment_directory}/*/Logs/*.pkl"):
-            job = pickle.load(open(job_path, "rb"))
+        """ Looks through the experiments directory and finds jobs. Adds them to dictionary if they aren't already there.
+        The job_id of a pickle is read from the job index, or from the pickle's header if the file changed, so
+        only jobs that we aren't already supervising get unpickled."""
+        job_paths = glob.glob(f"{self.experiment_directory}/*/Logs/*.pkl")
+        index_changed = set(self.job_index) != set(job_paths)
+        self.job_index = {path: entry for path, entry in self.job_index.items() if path in job_paths}
+        for job_path in job_paths:
+            try:
+                stat = os.stat(job_path)
+            except FileNotFoundError:
+                continue
+            entry = self.job_index.get(job_path)
+            if entry is None or (entry["mtime"], entry["size"]) != (stat.st_mtime, stat.st_size):
+                header = read_job_header(job_path)
+                entry = {"mtime": stat.st_mtime, "size": stat.st_size, "job_id": header.job_id if header else None}
+                self.job_index[job_path] = entry
+                index_changed = True
+            if entry["job_id"] is not None and entry["job_id"] in self.jobs:
+                continue
+            try:
+                with open(job_path, "rb") as fp:
+                    job = pickle.load(fp)
+            except Exception as e:
+                # E.g. a pickle written by an older version in place. Left out of the index, so it is retried.
+                self.write_to_logfile(f"Could not load {job_path}, retrying later: {e}")
+                del self.job_index[job_path]
+                index_changed = True
+                continue
+            if entry["job_id"] != job.job_id:
+                entry["job_id"] = job.job_id
+                index_changed = True
             if job.job_id not in self.jobs.keys():
                 self.jobs[job.job_id] = job
+                self.schedule_check(job.job_id, 0)
+                if self.retention is not None:
+                    self.retention.add_target(job.bucket.name, f"{job.trainer.experiment_directory}/trainstate")
+        if index_changed:
+            self.save_job_index()
 
-    def get_tpu(self, job):
-        """ Helper function that builds a TPU manager if there isn't one, then finds (or creates) a TPU for the job"""
+    def get_manager(self, job):
+        """ Helper function that builds a TPU manager if there isn't one"""
         zone = job.trainer.get("tpu/kwargs/bucket")
         if self.managers.get(zone) is None:
             self.managers[zone] = TPUManager(**job.trainer.get("tpu/kwargs"))
-        tpu = self.managers[zone].get_tpus(job.trainer.get("distributed/kwargs/world_size"))[0]
+        return self.managers[zone]
+
+    def get_tpu(self, job):
+        """ Finds (or starts creating) a TPU for the job"""
+        # A job runs on one TPU (whose hosts make up its world), so asking for more would create unused VMs.
+        manager = self.get_manager(job)
+        tpu, *unused = manager.get_tpus(1, job.trainer.get("job/kwargs"))
+        for other in unused:
+            manager.give_back(other)
         return tpu
 
     def add_wandb_api_key(self, job):
@@ -56,53 +153,142 @@ class Nanny:
         job.trainer.set('job/kwargs/env_stmts', env_stmts)
         os.environ["WANDB_SILENT"] = "True"
 
-    def setup_job(self, job):
+    def setup_job(self, job, tpu):
         """ Builds the job, adding a TPU, wandb key """
-        tpu = self.get_tpu(job)
         job.set_tpu(tpu)
         self.add_wandb_api_key(job)
 
+    def bind_tpu(self, job_id):
+        """Finds a TPU for the job and sets the job up on it once the TPU exists. Returns False while the
+        TPU is still being created (the job is then launched on a later check) or if creating it failed."""
+        job = self.jobs[job_id]
+        if job_id not in self.provisioning:
+            self.write_to_logfile(f"Launching job {job}")
+            self.provisioning[job_id] = self.get_tpu(job)
+        tpu = self.provisioning[job_id]
+        manager = self.get_manager(job)
+        if manager.is_provisioning(tpu):
+            return False
+        del self.provisioning[job_id]
+        tpu = manager.provisioned(tpu)
+        if tpu is None:
+            self.write_to_logfile(f"Could not create a TPU for {job.name}, trying again.")
+            return False
+        self.setup_job(job, tpu)
+        manager.release(tpu)
+        return True
+
+    def launch_job(self, job_id):
+        job = self.jobs[job_id]
+        if not self.bind_tpu(job_id):
+            return
+        job_proc = Process(target=job.launch, daemon=False)
+        job_proc.start()
+        self.job_procs[job_id] = job_proc
+
     def launch_jobs(self):
         for job_id, job in self.jobs.items():
             if job.status in {JobState.ARMED, JobState.RUNNING, JobState.SUCCESS}:
                 continue
-            self.write_to_logfile(f"Launching job {job}")
-            self.setup_job(job)
-            job_proc = Process(target=job.launch, daemon=False)
-            job_proc.start()
-            self.job_procs[job_id] = job_proc
+            self.launch_job(job_id)
+
+    def cleanup_job(self, job_id):
+        """Cleans up the job if its process died or its heartbeat stopped. Returns True if it did."""
+        job = self.jobs[job_id]
+        job_proc = self.job_procs[job_id]
+        proc_died = not job_proc.is_alive()
+        heartbeat_stopped = not job.is_alive
+        if not (proc_died or heartbeat_stopped):
+            return False
+        self.write_to_logfile(f"Nanny cleaning up the dead job {job.name} with heartbeat stopped: {heartbeat_stopped} and proc_died: {proc_died}.")
+        job.write_to_logfile(f"Nanny cleaning up the dead job {job.name} with heartbeat stopped: {heartbeat_stopped} and proc_died: {proc_died}.")
+        job.clean_up()
+        job_proc.terminate()
+        del self.job_procs[job_id]
+        del self.jobs[job_id]
+        # The job pickle is still on disk, so the job is rediscovered (and relaunched) right away.
+        self.jobs_changed.set()
+        return True
 
     def cleanup(self):
         # iterates over job_procs that have died
-        to_remove = []
-        for job_id, job in self.jobs.items():
-            job_proc = self.job_procs.get(job_id)
-            if job_proc is None:
-                continue
-            proc_died = not job_proc.is_alive()
-            heartbeat_stopped = not job.is_alive
-            if proc_died or heartbeat_stopped:
-                self.write_to_logfile(f"Nanny cleaning up the dead job {job.name} with heartbeat stopped: {heartbeat_stopped} and proc_died: {proc_died}.")
-                job.write_to_logfile(f"Nanny cleaning up the dead job {job.name} with heartbeat stopped: {heartbeat_stopped} and proc_died: {proc_died}.")
-                job.clean_up()
-                job_proc.terminate()
-                del self.job_procs[job_id]
-                to_remove.append(job_id)
+        for job_id in list(self.jobs.keys()):
+            if self.job_procs.get(job_id) is not None:
+                self.cleanup_job(job_id)
+
+    def schedule_check(self, job_id, delay):
+        heapq.heappush(self.schedule, (time.time() + delay, job_id))
+
+    def backoff(self, job_id):
+        """Doubles the check interval of a healthy job, up to MAX_CHECK_INTERVAL."""
+        interval = min(self.check_intervals.get(job_id, CHECK_INTERVAL) * 2, MAX_CHECK_INTERVAL)
+        self.check_intervals[job_id] = interval
+        return interval
 
-        for job_id in to_remove:
-            del self.jobs[job_id]
+    def check_job(self, job_id):
+        """Launches or cleans up one job, then schedules its next check."""
+        if job_id not in self.jobs:
+            self.check_intervals.pop(job_id, None)
+            return
+        if self.job_procs.get(job_id) is None:
+            if self.jobs[job_id].status in {JobState.ARMED, JobState.RUNNING, JobState.SUCCESS}:
+                self.schedule_check(job_id, self.backoff(job_id))
+                return
+            self.launch_job(job_id)
+            self.check_intervals[job_id] = CHECK_INTERVAL
+            self.schedule_check(job_id, CHECK_INTERVAL)
+        elif self.cleanup_job(job_id):
+            self.check_intervals.pop(job_id, None)
+        else:
+            self.schedule_check(job_id, self.backoff(job_id))
 
+    def check_due_jobs(self):
+        now = time.time()
+        # A dead job process is noticed locally, without waiting for the job's next check.
+        for job_id, job_proc in self.job_procs.items():
+            if not job_proc.is_alive():
+                self.schedule_check(job_id, 0)
+        due = set()
+        while self.schedule and self.schedule[0][0] <= now:
+            due.add(heapq.heappop(self.schedule)[1])
+        # A job can be in the heap several times, but only needs one check.
+        self.schedule = [(deadline, job_id) for deadline, job_id in self.schedule if job_id not in due]
+        heapq.heapify(self.schedule)
+        for job_id in due:
+            self.check_job(job_id)
+
+    def watch(self):
+        """Watches the experiment directory for new or changed job pickles, if watchdog is installed."""
+        if Observer is None:
+            return
+        handler = PatternMatchingEventHandler(patterns=["*/Logs/*.pkl"], ignore_directories=True)
+        handler.on_any_event = lambda event: self.jobs_changed.set()
+        self.observer = Observer()
+        self.observer.schedule(handler, self.experiment_directory, recursive=True)
+        self.observer.daemon = True
+        self.observer.start()
 
     def run(self):
+        if self.retention is not None:
+            self.retention.start()
+        self.watch()
+        next_discovery = 0
         while True:
-            self.find_jobs()
-            self.launch_jobs()
-            self.cleanup()
-            self.write_to_logfile([job for job in self.jobs.values()])
-            time.sleep(5)
+            if self.jobs_changed.is_set() or time.time() >= next_discovery:
+                self.jobs_changed.clear()
+                self.find_jobs()
+                self.write_to_logfile([job for job in self.jobs.values()])
+                next_discovery = time.time() + DISCOVERY_INTERVAL
+            self.check_due_jobs()
+            next_deadline = min([next_discovery] + [deadline for deadline, _ in self.schedule[:1]])
+            # Wake up at least every second to notice dead job processes.
+            self.jobs_changed.wait(min(max(next_deadline - time.time(), 0), 1))
 
     def exit_gracefully(self, signum, frame):
         self.write_to_logfile("Exiting gracefully")
+        # TPUs still being created for jobs that never got them are handed back.
+        for job_id, tpu in self.provisioning.items():
+            self.get_manager(self.jobs[job_id]).give_back(tpu)
         for job_id, job in self.jobs.items():
             job_proc = self.job_procs.get(job_id)
             if job_proc is not None:
@@ -111,10 +297,132 @@ class Nanny:
         sys.exit(0)
 
 
+class AsyncNanny(Nanny):
+    """Supervises every job in its own asyncio task, with the same find / launch / cleanup logic as
+    Nanny. Blocking gcloud and GCS calls run on a bounded thread pool with a timeout, so a slow or hung
+    call only holds up the job it belongs to."""
+
+    def __init__(self, experiment_directory, retention=None):
+        super(AsyncNanny, self).__init__(experiment_directory, retention=retention)
+        self.executor = ThreadPoolExecutor(max_workers=BLOCKING_CALL_WORKERS)
+        self.tasks = dict()
+        self.setup_lock = None
+        # Futures of the bind_tpu calls still running, by job id.
+        self.binds = dict()
+
+    async def call(self, fn, *args):
+        # A call that times out keeps its thread until it returns, but the job's task moves on.
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(self.executor, fn, *args), timeout=BLOCKING_CALL_TIMEOUT)
+
+    def schedule_check(self, job_id, delay):
+        # Every job has its own task, so there is no shared schedule to maintain.
+        pass
+
+    async def launch_job_async(self, job_id):
+        job = self.jobs[job_id]
+        # TPUManager picks TPU names from its own state, so jobs get their TPUs one at a time.
+        async with self.setup_lock:
+            # A bind that timed out keeps running in its thread, so on the next check it is awaited
+            # again instead of starting a second one that would claim another TPU for the job.
+            bind = self.binds.get(job_id)
+            if bind is None:
+                bind = self.binds[job_id] = asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.bind_tpu, job_id
+                )
+            try:
+                bound = await asyncio.wait_for(asyncio.shield(bind), timeout=BLOCKING_CALL_TIMEOUT)
+            finally:
+                if bind.done():
+                    del self.binds[job_id]
+            if not bound:
+                return
+        job_proc = Process(target=job.launch, daemon=False)
+        job_proc.start()
+        self.job_procs[job_id] = job_proc
+
+    async def cleanup_job_async(self, job_id):
+        job = self.jobs[job_id]
+        job_proc = self.job_procs[job_id]
+        proc_died = not job_proc.is_alive()
+        heartbeat_stopped = False if proc_died else not await self.call(lambda: job.is_alive)
+        if not (proc_died or heartbeat_stopped):
+            return False
+        self.write_to_logfile(f"Nanny cleaning up the dead job {job.name} with heartbeat stopped: {heartbeat_stopped} and proc_died: {proc_died}.")
+        job.write_to_logfile(f"Nanny cleaning up the dead job {job.name} with heartbeat stopped: {heartbeat_stopped} and proc_died: {proc_died}.")
+        await self.call(job.clean_up)
+        job_proc.terminate()
+        del self.job_procs[job_id]
+        del self.jobs[job_id]
+        self.jobs_changed.set()
+        return True
+
+    async def supervise(self, job_id):
+        while job_id in self.jobs:
+            try:
+                if self.job_procs.get(job_id) is None:
+                    status = await self.call(lambda: self.jobs[job_id].status)
+                    if status in {JobState.ARMED, JobState.RUNNING, JobState.SUCCESS}:
+                        interval = self.backoff(job_id)
+                    else:
+                        await self.launch_job_async(job_id)
+                        interval = self.check_intervals[job_id] = CHECK_INTERVAL
+                elif await self.cleanup_job_async(job_id):
+                    break
+                else:
+                    interval = self.backoff(job_id)
+            except asyncio.TimeoutError:
+                self.write_to_logfile(f"Checking job {job_id} timed out, retrying.")
+                interval = CHECK_INTERVAL
+            except Exception as e:
+                self.write_to_logfile(f"Checking job {job_id} failed with {e}, retrying.")
+                interval = CHECK_INTERVAL
+            await self.sleep_or_wake(job_id, interval)
+        self.check_intervals.pop(job_id, None)
+        self.tasks.pop(job_id, None)
+
+    async def sleep_or_wake(self, job_id, interval):
+        """Sleeps for interval seconds, or less if the job's process dies in the meantime."""
+        for _ in range(int(interval)):
+            job_proc = self.job_procs.get(job_id)
+            if job_proc is not None and not job_proc.is_alive():
+                return
+            await asyncio.sleep(1)
+
+    async def run_async(self):
+        self.setup_lock = asyncio.Lock()
+        if self.retention is not None:
+            self.retention.start()
+        self.watch()
+        while True:
+            try:
+                await self.call(self.find_jobs)
+            except asyncio.TimeoutError:
+                self.write_to_logfile("Finding jobs timed out, retrying.")
+            for job_id in list(self.jobs.keys()):
+                if job_id not in self.tasks:
+                    self.tasks[job_id] = asyncio.create_task(self.supervise(job_id))
+            self.write_to_logfile([job for job in self.jobs.values()])
+            await self.call(self.jobs_changed.wait, DISCOVERY_INTERVAL)
+            self.jobs_changed.clear()
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+
 @click.command(
     context_settings=dict(ignore_unknown_options=True, allow_extra_args=True)
 )
 @click.argument("experiment_directory")
-def main(experiment_directory, **kwargs):
-    nanny = Nanny(experiment_directory)
+@click.option("--keep-last", type=int, help="Garbage collect all but the last N checkpoints of every job.")
+@click.option("--keep-every", type=int, help="Keep the checkpoints whose step is a multiple of K.")
+@click.option("--gc-interval", type=int, default=3600, help="Seconds between checkpoint garbage collections.")
+@click.option("--use-asyncio", is_flag=True, help="Supervise every job in its own asyncio task.")
+def main(experiment_directory, keep_last=None, keep_every=None, gc_interval=3600, use_asyncio=False, **kwargs):
+    retention = None
+    policies = retention_policies(keep_last=keep_last, keep_every=keep_every)
+    if policies:
+        retention = RetentionTask(policies, interval=gc_interval)
+    nanny_cls = AsyncNanny if use_asyncio else Nanny
+    nanny = nanny_cls(experiment_directory, retention=retention)
     nanny.run()
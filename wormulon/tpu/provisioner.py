@@ -0,0 +1,68 @@
+import time
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from wormulon.tpu.tpu import TPU
+
+# Maximum number of TPUs being created at the same time in one zone.
+ZONE_CONCURRENCY = 4
+# Attempts per placement (zone and bucket) before falling back to the next one.
+CREATE_ATTEMPTS = 4
+# Seconds waited after the first quota or stockout error, doubled after every further one.
+CREATE_BACKOFF = 30
+MAX_CREATE_BACKOFF = 600
+# Substrings of the errors that mean the zone is out of capacity or quota, so retrying later can help.
+CAPACITY_ERRORS = ("resource_exhausted", "quota", "stockout", "capacity")
+
+
+def is_capacity_error(message):
+    message = str(message).lower()
+    return any(error in message for error in CAPACITY_ERRORS)
+
+
+class Provisioner(object):
+    """Creates TPUs concurrently, at most zone_concurrency at a time per zone.
+
+    tpu_kwargs is the primary placement, and fallbacks is a list of dicts overriding some of its keys
+    (e.g. zone, bucket, network). A create that fails with a quota or stockout error is retried with
+    exponential backoff, then tried on the next placement. provision returns a Future of the TPU, which
+    is None if every placement failed."""
+
+    def __init__(self, tpu_kwargs, fallbacks=(), zone_concurrency=ZONE_CONCURRENCY):
+        self.placements = [dict(tpu_kwargs)] + [dict(tpu_kwargs, **fallback) for fallback in fallbacks]
+        self.semaphores = defaultdict(lambda: threading.Semaphore(zone_concurrency))
+        self.executor = ThreadPoolExecutor(max_workers=zone_concurrency * len(self.placements))
+
+    def provision(self, name):
+        return self.executor.submit(self.create, name)
+
+    def create(self, name):
+        # The result is read by the nanny's loop, so an error here must not escape the future.
+        try:
+            return self.try_placements(name)
+        except Exception as e:
+            print(f"Failed to create tpu {name}: {e}")
+            return None
+
+    def try_placements(self, name):
+        for placement in self.placements:
+            tpu = TPU(name, **placement)
+            backoff = CREATE_BACKOFF
+            for attempt in range(CREATE_ATTEMPTS):
+                with self.semaphores[tpu.zone]:
+                    try:
+                        output, retcode = tpu.create()
+                    except Exception as e:
+                        output, retcode = e, 1
+                if retcode == 0 or tpu.is_ready:
+                    print(f"Created tpu {name} in {tpu.zone}")
+                    return tpu
+                print(f"Failed to create tpu {name} in {tpu.zone} (attempt {attempt + 1}): {output}")
+                if tpu.name in tpu.inventory.names:
+                    # A half created TPU would make the next create fail because the name is taken.
+                    tpu.delete()
+                if not is_capacity_error(output):
+                    break
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_CREATE_BACKOFF)
+        return None
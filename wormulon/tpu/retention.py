@@ -0,0 +1,99 @@
+import time
+import threading
+from wormulon.tpu.bucket import Bucket
+
+
+class RetentionPolicy(object):
+    def keep(self, checkpoints):
+        """Takes one experiment's checkpoints (Experiment tuples sorted by step), returns the ones to keep."""
+        raise NotImplementedError
+
+
+class KeepLast(RetentionPolicy):
+    def __init__(self, n):
+        self.n = n
+
+    def keep(self, checkpoints):
+        return checkpoints[-self.n:] if self.n > 0 else []
+
+
+class KeepEvery(RetentionPolicy):
+    def __init__(self, k):
+        self.k = k
+
+    def keep(self, checkpoints):
+        return [checkpoint for checkpoint in checkpoints if checkpoint.step % self.k == 0]
+
+
+class KeepBest(RetentionPolicy):
+    """Keeps the n checkpoints with the best value of a metric stored in their blob metadata."""
+
+    def __init__(self, metric, n=1, mode="min"):
+        self.metric = metric
+        self.n = n
+        self.mode = mode
+
+    def keep(self, checkpoints):
+        scored = [checkpoint for checkpoint in checkpoints if (checkpoint.blob.metadata or {}).get(self.metric) is not None]
+        scored.sort(key=lambda checkpoint: float(checkpoint.blob.metadata[self.metric]), reverse=(self.mode == "max"))
+        return scored[:self.n]
+
+
+def plan_deletions(bucket, policies, prefix=None):
+    """Returns the names of the blobs to delete: all blobs of checkpoints that no policy keeps.
+    The latest checkpoint of every experiment and the bases of kept delta checkpoints are always kept."""
+    blobs = bucket.list(prefix=prefix, match_glob="**trainstate**")
+    to_delete = []
+    for checkpoints in bucket.list_checkpoints(blobs=blobs).values():
+        kept = {checkpoints[-1].blob.name}
+        for policy in policies:
+            kept.update(checkpoint.blob.name for checkpoint in policy.keep(checkpoints))
+        kept.update((checkpoint.blob.metadata or {}).get("base") for checkpoint in checkpoints
+                    if checkpoint.blob.name in kept)
+        for checkpoint in checkpoints:
+            if checkpoint.blob.name in kept:
+                continue
+            path = Bucket.checkpoint_path(checkpoint.blob)
+            to_delete.append(checkpoint.blob.name)
+            if path != checkpoint.blob.name:
+                # Sharded checkpoint: its shards live in the directory next to the manifest.
+                to_delete.extend(blob.name for blob in blobs
+                                 if blob.name.startswith(f"{path}/") and blob.name != checkpoint.blob.name)
+    return to_delete
+
+
+def collect_garbage(bucket, policies, prefix=None, dry_run=False):
+    to_delete = plan_deletions(bucket, policies, prefix=prefix)
+    for name in to_delete:
+        print(f"{'Would delete' if dry_run else 'Deleting'} {bucket.name}/{name}")
+    if not dry_run and to_delete:
+        bucket.delete_blobs(to_delete)
+    return to_delete
+
+
+class RetentionTask(object):
+    """Runs collect_garbage on a set of (bucket name, prefix) targets every `interval` seconds
+    on a daemon thread."""
+
+    def __init__(self, policies, interval=3600):
+        self.policies = policies
+        self.interval = interval
+        self.targets = set()
+        self._thread = None
+
+    def add_target(self, bucket_name, prefix):
+        self.targets.add((bucket_name, prefix))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for bucket_name, prefix in list(self.targets):
+                try:
+                    collect_garbage(Bucket(bucket_name), self.policies, prefix=prefix)
+                except Exception as e:
+                    print(f"Checkpoint garbage collection of {bucket_name}/{prefix} failed: {e}")
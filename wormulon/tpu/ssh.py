@@ -0,0 +1,57 @@
+import os
+import time
+from wormulon.utils import execute
+
+# Control sockets of the multiplexed SSH connections, one per TPU host.
+CONTROL_DIR = os.path.expanduser("~/.ssh/wormulon")
+# Seconds an idle master connection is kept open.
+CONTROL_PERSIST = 600
+# Seconds before retrying to open a master connection that could not be opened.
+MASTER_RETRY_INTERVAL = 300
+
+# Hosts for which opening a master connection failed, and when.
+_failed_masters = dict()
+
+
+def control_path(host):
+    return os.path.join(CONTROL_DIR, f"cm-{host}")
+
+
+def has_master(host):
+    """Checks whether there is a live master connection for host."""
+    if not os.path.exists(control_path(host)):
+        return False
+    _, _, retcode = execute(
+        ["ssh", "-o", f"ControlPath={control_path(host)}", "-O", "check", host], capture_output=True, check=False
+    )
+    return retcode == 0
+
+
+def open_master(name, zone, host, worker=0):
+    """Opens a master connection to a TPU VM with gcloud, which also takes care of propagating the SSH keys.
+    Later commands go over this connection with plain ssh, without starting gcloud or a new handshake."""
+    if time.time() - _failed_masters.get(host, 0) < MASTER_RETRY_INTERVAL:
+        return False
+    os.makedirs(CONTROL_DIR, exist_ok=True)
+    command = [
+        "gcloud", "alpha", "compute", "tpus", "tpu-vm", "ssh", name, "--zone", zone, f"--worker={worker}",
+        "--command", "true",
+        "--ssh-flag=-oControlMaster=auto",
+        f"--ssh-flag=-oControlPath={control_path(host)}",
+        f"--ssh-flag=-oControlPersist={CONTROL_PERSIST}",
+    ]
+    execute(command, capture_output=True, check=False)
+    if not has_master(host):
+        _failed_masters[host] = time.time()
+        return False
+    return True
+
+
+def close_master(host):
+    if os.path.exists(control_path(host)):
+        execute(["ssh", "-o", f"ControlPath={control_path(host)}", "-O", "exit", host], capture_output=True, check=False)
+
+
+def multiplexed_command(host, cmd):
+    """An ssh command that runs cmd over the master connection of host."""
+    return ["ssh", "-o", "ControlMaster=no", "-o", f"ControlPath={control_path(host)}", host, cmd]
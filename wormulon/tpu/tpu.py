@@ -1,9 +1,26 @@
 import torch
 import time
+import json
+import hashlib
 import asyncio
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from wormulon.tpu.fncall import FunctionCall
 from wormulon.utils import execute, serialize
 from wormulon.tpu.bucket import Bucket
+from wormulon.tpu.inventory import get_inventory
+from wormulon.tpu.backend import get_backend
+from wormulon.tpu.ssh import has_master, open_master, close_master, multiplexed_command
+
+# File on the TPU VM holding the fingerprint of the environment its setup commands installed.
+FINGERPRINT_PATH = "~/.wormulon-env-fingerprint"
+
+
+def environment_fingerprint(setup_cmds, install_cmd):
+    """Hash of the commands that set up a TPU VM. The env_stmts are left out, as they are prepended to
+    every command rather than installed on the VM."""
+    return hashlib.sha256(json.dumps([list(setup_cmds or []), install_cmd]).encode()).hexdigest()[:16]
+
 
 class TPU:
     def __init__(
@@ -26,70 +43,146 @@ class TPU:
         self.acc_type = acc_type
         self.preemptible = preemptible
         self.bucket = Bucket(bucket)
+        # Set when the TPU comes out of TPUManager's warm pool, already set up for the job's commands.
+        self.warm = False
 
     def __repr__(self):
         return f"TPU({self.name})"
 
+    @property
+    def inventory(self):
+        return get_inventory(self.zone)
+
     @property
     def is_ready(self):
-        command = f"gcloud compute tpus list --format=value(NAME,STATUS) --zone {self.zone}"
-        stdout, stderr, retcode = execute(command.split(), capture_output=True)
-        rows = stdout.split("\n")
-        rows.remove("")
-        names = {r.split("\t")[0] for r in rows if r.split("\t")[1] == "READY"}
-        return self.name in names
+        return self.name in self.inventory.ready
 
     def delete(self):
         print(f"deleting tpu {self.name}")
-        return execute(
-            f"gcloud alpha compute tpus tpu-vm delete {self.name} --zone {self.zone} --async --quiet".split()
-        )
+        for worker in range(self.num_workers):
+            close_master(self.worker_host(worker))
+        output = get_backend().delete_node(self.name, self.zone)
+        self.inventory.invalidate()
+        return output
 
     def create(self):
-        while True:
-            command = f"gcloud alpha compute tpus tpu-vm create {self.name} \
-              --zone {self.zone} \
-              --network {self.network} \
-              --subnetwork {self.subnet} \
-              --range {self.netrange} \
-              --accelerator-type {self.acc_type} \
-              --version tpu-vm-pt-1.10 \
-               {'--preemptible' if self.preemptible else ''}"
-            command = command.split()
-            command.append("--metadata")
-            command.append("shutdown-script=\'#! /bin/bash;"
-                           ""
-                           " pgrep -f python3 | xargs kill -SIGTERM;"
-                           " while pgrep -f python3 > /dev/null;"
-                           " do sleep 1; "
-                           "done; \'")
-            stdout, stderr, retcode = execute(command, capture_output=True, timeout=300)
-            if retcode == 0:
-                return stdout, retcode
-            else:
-                return stderr, retcode
+        output, retcode = get_backend().create_node(
+            self.name, self.zone, self.network, self.subnet, self.netrange, self.acc_type, self.preemptible
+        )
+        self.inventory.invalidate()
+        return output, retcode
 
-    def ssh(self, cmd, env_stmts=[], run_async=False, capture_output=False, check=True):
+    @property
+    def ssh_host(self):
+        return self.worker_host(0)
+
+    def worker_host(self, worker):
+        # Multiplexed connections are keyed on the worker's address, or on its name while that is unknown.
+        tpu = self.inventory.get(self.name)
+        if tpu is not None and worker < len(tpu.ip_addresses) and tpu.ip_addresses[worker]:
+            return tpu.ip_addresses[worker]
+        return self.name if worker == 0 else f"{self.name}-w{worker}"
+
+    @property
+    def num_workers(self):
+        """Number of hosts in the TPU, e.g. 4 for a v3-32."""
+        tpu = self.inventory.get(self.name)
+        if tpu is not None and tpu.ip_addresses:
+            return len(tpu.ip_addresses)
+        return max(1, int(self.acc_type.split("-")[-1]) // 8)
+
+    def ssh_command(self, cmd, env_stmts=[], worker=0):
+        for env_stmt in env_stmts:
+            cmd = env_stmt + cmd
+        host = self.worker_host(worker)
+        if has_master(host) or open_master(self.name, self.zone, host, worker=worker):
+            return multiplexed_command(host, cmd)
         command = (
             f"gcloud alpha compute tpus tpu-vm ssh "
             f"{self.name} "
             f"--zone {self.zone} "
+            f"--worker={worker} "
             f"--command "
         )
         command = command.split()
-        for env_stmt in env_stmts:
-            cmd = env_stmt + cmd
         command.append(cmd)
+        return command
+
+    def ssh(self, cmd, env_stmts=[], run_async=False, capture_output=False, check=True):
+        command = self.ssh_command(cmd, env_stmts)
         stdout, stderr, retcode = execute(command, run_async=run_async, capture_output=capture_output, check=check)
         if run_async:
             return stdout
         return stdout, stderr, retcode
 
+    def ssh_worker(self, worker, cmd, env_stmts=[], log=print):
+        proc = subprocess.Popen(
+            self.ssh_command(cmd, env_stmts, worker=worker), stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        for line in proc.stdout:
+            log(f"worker-{worker}: {line.decode('utf-8', errors='replace').rstrip()}")
+        return proc.wait()
+
+    def ssh_all(self, cmd, env_stmts=[], log=print):
+        """Runs cmd on every worker of the TPU at the same time, like `--worker=all`. Output lines are
+        passed to log as they arrive, tagged with their worker. Returns {worker: retcode}."""
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = {
+                worker: executor.submit(self.ssh_worker, worker, cmd, env_stmts, log)
+                for worker in range(self.num_workers)
+            }
+        return {worker: future.result() for worker, future in futures.items()}
+
+    def run_on_workers(self, cmd, env_stmts=[], log=print, check=True):
+        """Runs cmd on every worker of the TPU. The workers of a pod slice run it concurrently and their
+        output goes to log tagged by worker. Returns 1 if cmd failed on any worker, like execute does
+        for a single host, else 0."""
+        if self.num_workers == 1:
+            _, _, retcode = self.ssh(cmd, env_stmts, capture_output=True, check=check)
+            return retcode
+        retcodes = self.ssh_all(cmd, env_stmts, log=log)
+        failed = {worker: retcode for worker, retcode in retcodes.items() if retcode != 0}
+        if failed:
+            log(f"{cmd} failed on workers {failed}")
+            return 1
+        return 0
+
+    @property
+    def fingerprint(self):
+        """Fingerprint of the environment installed on the VM, or None if it was never set up."""
+        stdout, _, retcode = self.ssh(f"cat {FINGERPRINT_PATH}", capture_output=True, check=False)
+        return stdout.strip() if retcode == 0 and stdout.strip() else None
+
+    def prepare(self, setup_cmds, install_cmd, env_stmts=[], log=print, skip_if_prepared=False):
+        """Runs the setup commands on every worker, and the install command if one of them fails, then records
+        the environment fingerprint on the VM. With skip_if_prepared, does nothing if the VM already has this
+        environment. Returns False if the install failed."""
+        fingerprint = environment_fingerprint(setup_cmds, install_cmd)
+        if skip_if_prepared and self.fingerprint == fingerprint:
+            log(f"{self} already has environment {fingerprint}, skipping setup")
+            return True
+        ok = True
+        for cmd in setup_cmds:
+            log(f"Running setup command: {cmd}")
+            retcode = self.run_on_workers(cmd, env_stmts, log=log)
+            ok = ok and retcode == 0
+            # If we need to install everything we get an error and then do it here
+            if retcode == 1:
+                log(f"Installing {install_cmd}")
+                if self.run_on_workers(install_cmd, env_stmts, log=log) != 0:
+                    return False
+                ok = True
+                break
+        if ok:
+            self.run_on_workers(f"echo {fingerprint} > {FINGERPRINT_PATH}", check=False)
+        return True
+
     @property
     def ip_address(self):
-        command = f"gcloud compute tpus describe {self.name} --zone {self.zone} --format=value(networkEndpoints[0].ipAddress)"
-        stdout, stderr, retcode = execute(command.split(), capture_output=True)
-        return stdout.strip()
+        tpu = self.inventory.get(self.name)
+        if tpu is None or not tpu.ip_addresses:
+            return ""
+        return tpu.ip_addresses[0]
 
     def clean_up(self):
         self.ssh("pkill -9 python3")
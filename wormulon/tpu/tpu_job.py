@@ -1,17 +1,36 @@
-import io
 import os
 import asyncio
 import pickle
 import time
+import selectors
 import wandb
 from datetime import datetime, timezone, timedelta
 from wormulon.core import Job
 from wormulon.utils import dump_yaml, load_yaml
-from wormulon.utils import JobState
+from wormulon.utils import JobState, JOB_END_SENTINEL
 from wormulon.train_state import TrainState
 from wormulon.tpu.bucket import Bucket
 from wormulon.tpu.fncall import FunctionCall
 
+def job_header_path(pickle_path):
+    """Path of the small yaml header written next to a job pickle."""
+    return f"{os.path.splitext(pickle_path)[0]}.header.yml"
+
+
+def read_job_header(pickle_path):
+    """Reads the header of a job pickle (job_id, name, rank) without unpickling the job and its trainer.
+    Returns None for pickles that have no header."""
+    try:
+        with open(job_header_path(pickle_path), "r") as fp:
+            return load_yaml(fp.read())
+    except FileNotFoundError:
+        return None
+
+
+# Seconds between flushes of the job log while the train command is streaming output.
+LOG_FLUSH_INTERVAL = 5
+
+
 class TPUJob(Job):
     def __init__(self, trainer):
         super().__init__()
@@ -84,35 +103,60 @@ class TPUJob(Job):
         )
 
     def nonblocking_ssh(self, cmd, env):
+        """Runs cmd on the TPU and streams its stdout and stderr line by line into the logfile until it exits.
+        Returns True if the job signalled that it finished, else the exit code of the ssh command."""
         proc = self.tpu.ssh(cmd, env, run_async=True)
+        rank = self.trainer.get('distributed/kwargs/rank')
+        selector = selectors.DefaultSelector()
+        buffers = {}
+        for stream in (proc.stdout, proc.stderr):
+            selector.register(stream, selectors.EVENT_READ)
+            buffers[stream] = b""
+        finished = False
 
-        while True:
-            curtime = time.strftime('%X')
-            out = proc.stdout.read()
-            err = proc.stderr.read()
-            out = out.decode("utf-8") if out else ""
-            err = err.decode("utf-8") if err else ""
-            if out != "":
-                out = f"{self.name}, {self.tpu}, {curtime}, job-{self.trainer.get('distributed/kwargs/rank')}: {out}"
-                self.write_to_logfile(out)
-            if err != "":
-                err = f"{self.name}, {self.tpu}, {curtime}, job-{self.trainer.get('distributed/kwargs/rank')}: {err}"
-                self.write_to_logfile(err)
-            poll = proc.poll()
-            if poll is None:
-                time.sleep(1)
-            elif "Finished worker" in out:
-                return True
-            else:
-                return poll
+        with open(self.logfile_path, "a+") as fp:
+            last_flush = time.time()
+            while selector.get_map():
+                lines = []
+                for key, _ in selector.select(timeout=LOG_FLUSH_INTERVAL):
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        # EOF, so whatever is left is the last line.
+                        selector.unregister(key.fileobj)
+                        chunk = b"\n" if buffers[key.fileobj] else b""
+                    *complete, buffers[key.fileobj] = (buffers[key.fileobj] + chunk).split(b"\n")
+                    lines.extend(complete)
+                curtime = time.strftime('%X')
+                for line in lines:
+                    line = line.decode("utf-8", errors="replace")
+                    if line.startswith(JOB_END_SENTINEL):
+                        finished = True
+                        line = f"Job ended: {line[len(JOB_END_SENTINEL):].strip()}"
+                        print(line, flush=True)
+                    finished = finished or "Finished worker" in line
+                    fp.write(f"{self.name}, {self.tpu}, {curtime}, job-{rank}: {line}\n")
+                if time.time() - last_flush > LOG_FLUSH_INTERVAL:
+                    fp.flush()
+                    last_flush = time.time()
+        selector.close()
+        retcode = proc.wait()
+        return True if finished else retcode
 
     @property
     def local_pickle_path(self):
         return f"{self.trainer.experiment_directory}/Logs/job-{self.trainer.get('distributed/kwargs/rank')}.pkl"
 
     def write_to_disk(self):
-        with open(self.local_pickle_path, "wb") as fp:
+        # The header goes first and the pickle last, so whenever the nanny sees a new pickle it also sees its
+        # header. Both are written next to their file and moved over it, so they are never read half written.
+        header = {"job_id": self.job_id, "name": self.name, "rank": self.trainer.get('distributed/kwargs/rank')}
+        header_path = job_header_path(self.local_pickle_path)
+        with open(f"{header_path}.tmp", "w") as fp:
+            fp.write(dump_yaml(header))
+        os.replace(f"{header_path}.tmp", header_path)
+        with open(f"{self.local_pickle_path}.tmp", "wb") as fp:
             pickle.dump(self, fp)
+        os.replace(f"{self.local_pickle_path}.tmp", self.local_pickle_path)
 
     def setup_wandb(self):
         wandb_run = wandb.init(name=self.trainer.wandb_run_name, job_type=self.trainer.WANDB_JOB_TYPE,
@@ -133,7 +177,7 @@ class TPUJob(Job):
     @property
     def status(self):
         try:
-            state = load_yaml(self.bucket.download(self.job_state_path).getvalue())['state']
+            state = self.bucket.read_jobstate(self.job_state_path)['state']
         except Exception as e:
             self.write_to_logfile(e)
             state = JobState.UNKNOWN.value
@@ -167,10 +211,8 @@ class TPUJob(Job):
         else:
             return False
 
-        # Get Job State from server
-        bytes = blob.download_as_bytes()
-        buffer = io.BytesIO(bytes)
-        state = JobState(load_yaml(buffer.getvalue())['state'])
+        # Get Job State, only downloading it from the server if it changed
+        state = JobState(self.bucket.jobstate_from_blob(blob)['state'])
 
         self.write_to_logfile(f"updated: {updated}, self.last_heartbeat: {self.last_heartbeat}, state: {state}")
 
@@ -207,28 +249,26 @@ class TPUJob(Job):
             self.write_to_logfile(f"Failed to launch {self.name} on TPU: {self.tpu}")
             raise Exception(f"Failed to launch {self.name} on TPU: {self.tpu}")
         self.write_to_logfile(f"Successfully snagged a TPU ({self.tpu}) for job {self.name}. Booting now.")
-        self.tpu.ssh(self.cleanup, self.env, check=False)
+        self.run_on_workers(self.cleanup, check=False)
         self.function_call = FunctionCall(self.trainer, self.train_state, self.trainer.get("job/kwargs"), self.tpu.name)
         self.bucket.upload(self.function_call_serialization_path, self.function_call.serialize(), overwrite=True)
 
-        # setup the TPU
-        for cmd in self.setup:
-            self.write_to_logfile(f"Running setup command: {cmd}")
-            _, _, retcode = self.tpu.ssh(cmd, self.env, capture_output=True)
-            # If we need to install everything we get an error and then do it here
-            if retcode == 1:
-                self.write_to_logfile(f"Installing {self.install}")
-                _, _, retcode = self.tpu.ssh(self.install, self.env, run_async=False, capture_output=True)
-                if retcode != 0:
-                    self.write_to_logfile("Install Failed. Raising Exception.")
-                    raise Exception(f"Failed to install {self.install}")
-                break
+        # setup the TPU, unless it comes from the warm pool and was already set up for the same commands.
+        # Other TPUs run the setup commands every time, since they may do more than install (e.g. git pull).
+        skip_if_prepared = getattr(self.tpu, "warm", False)
+        if not self.tpu.prepare(self.setup, self.install, self.env, log=self.write_to_logfile,
+                                skip_if_prepared=skip_if_prepared):
+            self.write_to_logfile("Install Failed. Raising Exception.")
+            raise Exception(f"Failed to install {self.install}")
         self.bucket.upload(self.job_state_path, dump_yaml({"state": JobState.RUNNING.value, "tpu_name": self.tpu.name}), overwrite=True)
         train_cmd = f"{self.train} {self.bucket.name} {self.remote_working_directory}"
         self.write_to_logfile(f"Running train command: {train_cmd}")
         self.nonblocking_ssh(train_cmd, self.env)
         return self.function_call.outputs
 
+    def run_on_workers(self, cmd, check=True):
+        return self.tpu.run_on_workers(cmd, self.env, log=self.write_to_logfile, check=check)
+
     def __eq__(self, other):
         return self.job_id == other.job_id and self.created_at == other.created_at
 
@@ -1,35 +1,47 @@
-from wormulon.utils import execute, JobState
+import time
+import threading
+from wormulon.utils import JobState
 from wormulon.tpu.bucket import Bucket
-from wormulon.tpu.tpu import TPU
+from wormulon.tpu.tpu import TPU, environment_fingerprint
+from wormulon.tpu.inventory import get_inventory
+from wormulon.tpu.ledger import AllocationLedger
+from wormulon.tpu.provisioner import Provisioner, ZONE_CONCURRENCY
+
+# Seconds between two checks of the warm pool by its refill thread.
+WARM_POOL_INTERVAL = 60
 
 
 class TPUManager(object):
     def __init__(self, **kwargs):
+        kwargs = dict(kwargs)
+        # Number of TPUs kept created and set up ahead of the jobs that will need them.
+        self.warm_pool_size = kwargs.pop("warm_pool_size", 0)
+        # Other placements (dicts overriding e.g. zone and bucket) to create TPUs in when the zone is out of capacity.
+        fallback_placements = kwargs.pop("fallback_placements", [])
+        zone_concurrency = kwargs.pop("zone_concurrency", ZONE_CONCURRENCY)
         self.bucket = Bucket(kwargs.get("bucket"))
         self.zone = kwargs.get("zone")
         self.project = kwargs.get("project")
         self.tpu_kwargs = kwargs
         self.disarmed_but_busy_tpus = set()
+        # Leases on TPU names, so schedulers in other processes never pick the same TPU or name.
+        self.ledger = AllocationLedger(self.bucket, self.project)
+        self.provisioner = Provisioner(kwargs, fallback_placements, zone_concurrency=zone_concurrency)
+        # Futures of the TPUs being created, by name.
+        self.operations = dict()
+        # The set up TPUs that no job is bound to yet, by name, with the fingerprint of their environment.
+        self.warm_tpus = dict()
+        self.warm_job_kwargs = None
+        self.refill_thread = None
+        self.lock = threading.RLock()
 
     @property
-    def tpu_ids(self):
-        command = f"gcloud alpha compute tpus list --zone={self.zone} --format=value[seperator=','](name)"
-        stdout, stderr, retcode = execute(command.split(), capture_output=True)
-        ids = stdout.split("\n")
-        ids.remove("")
-        int_ids = [-1]
-        int_ids.extend([int(i.split("-")[-1]) for i in ids])
-        int_ids.extend([int(i.split("-")[-1]) for i in self.disarmed_but_busy_tpus])
-        return int_ids
+    def inventory(self):
+        return get_inventory(self.zone)
 
     @property
     def ready_tpus(self):
-        command = f"gcloud compute tpus list --format=value(NAME,STATUS) --zone {self.zone}"
-        stdout, stderr, retcode = execute(command.split(), capture_output=True)
-        rows = stdout.split("\n")
-        rows.remove("")
-        names = {r.split("\t")[0] for r in rows if r.split("\t")[1] == "READY"}
-        return names
+        return self.inventory.ready
 
     @property
     def busy_tpus(self):
@@ -39,19 +51,127 @@ class TPUManager(object):
     def available_tpus(self):
         return (self.ready_tpus - self.busy_tpus) - self.disarmed_but_busy_tpus
 
-    def get_tpus(self, num_tpus):
+    def new_tpu_name(self):
+        # The inventory covers the TPUs created before there was a ledger.
+        name = self.ledger.claim_new_name(taken=self.inventory.names | self.disarmed_but_busy_tpus)
+        with self.lock:
+            self.disarmed_but_busy_tpus.add(name)
+        return name
+
+    def release(self, tpu):
+        """Gives up the lease on a TPU, once it is bound to a job (whose jobstate marks it as busy) or
+        could not be created."""
+        self.ledger.release(tpu.name)
+
+    def give_back(self, tpu):
+        """Returns a TPU from get_tpus that will not be bound to a job: its creation is cancelled (or the TPU
+        deleted once created) and its lease released, so other schedulers can use the TPU or name."""
+        operation = self.operations.pop(tpu.name, None)
+        if operation is not None and not operation.cancel():
+            operation.add_done_callback(lambda future: future.result() and future.result().delete())
+        with self.lock:
+            self.disarmed_but_busy_tpus.discard(tpu.name)
+        self.release(tpu)
+
+    def get_tpus(self, num_tpus, job_kwargs=None):
+        """Returns num_tpus TPUs, preferring warm TPUs set up for the setup and install commands in job_kwargs,
+        then any ready TPU, and starts creating new ones for the rest. Every TPU is leased in the ledger."""
+        fingerprint = None
+        if job_kwargs is not None:
+            fingerprint = environment_fingerprint(job_kwargs.get("setup_cmds"), job_kwargs.get("install_cmd"))
+            self.start_warm_pool(job_kwargs)
         tpus = []
-        available_tpus = self.available_tpus.copy()
-        # print(f"available_tpus: {available_tpus}, disarmed_but_busy: {self.disarmed_but_busy_tpus}")
-        for _ in range(num_tpus):
-            if any(available_tpus):
-                name = available_tpus.pop()
-                print(f"Using existing TPU {name}")
-                tpu = TPU(name, **self.tpu_kwargs)
-            else:
-                name = f"{self.project}-{max(self.tpu_ids) + 1}"
-                print(f"Creating new tpu {name}")
-                tpu = TPU(name, **self.tpu_kwargs)
-                self.disarmed_but_busy_tpus.add(tpu.name)
-            tpus.append(tpu)
+        with self.lock:
+            busy_tpus = self.busy_tpus
+            available_tpus = (self.ready_tpus - busy_tpus) - self.disarmed_but_busy_tpus
+            warm_tpus = [
+                tpu for tpu, fp in self.warm_tpus.values() if fp == fingerprint and tpu.name not in busy_tpus and tpu.is_ready
+            ]
+            # print(f"available_tpus: {available_tpus}, disarmed_but_busy: {self.disarmed_but_busy_tpus}")
+            while len(tpus) < num_tpus:
+                if any(warm_tpus):
+                    tpu = warm_tpus.pop()
+                    if not self.ledger.claim(tpu.name):
+                        continue
+                    print(f"Using warm TPU {tpu.name}")
+                    tpu.warm = True
+                elif any(available_tpus):
+                    tpu = TPU(available_tpus.pop(), **self.tpu_kwargs)
+                    # Another scheduler may have just taken it.
+                    if not self.ledger.claim(tpu.name):
+                        continue
+                    print(f"Using existing TPU {tpu.name}")
+                else:
+                    tpu = TPU(self.new_tpu_name(), **self.tpu_kwargs)
+                    print(f"Creating new tpu {tpu.name}")
+                    self.operations[tpu.name] = self.provisioner.provision(tpu.name)
+                available_tpus.discard(tpu.name)
+                self.warm_tpus.pop(tpu.name, None)
+                tpus.append(tpu)
         return tpus
+
+    def is_provisioning(self, tpu):
+        operation = self.operations.get(tpu.name)
+        return operation is not None and not operation.done()
+
+    def provisioned(self, tpu):
+        """Returns the TPU once its creation is done: tpu itself if it was not being created here, the TPU
+        in the placement where it was created, or None if it could not be created anywhere."""
+        operation = self.operations.pop(tpu.name, None)
+        if operation is None:
+            return tpu
+        created = operation.result() if operation.exception() is None else None
+        if created is None:
+            with self.lock:
+                self.disarmed_but_busy_tpus.discard(tpu.name)
+            self.release(tpu)
+        return created
+
+    def start_warm_pool(self, job_kwargs):
+        """Keeps warm_pool_size TPUs set up with the setup and install commands of job_kwargs, refilling the
+        pool in a background thread as jobs take TPUs from it."""
+        if self.warm_pool_size <= 0:
+            return
+        self.warm_job_kwargs = job_kwargs
+        if self.refill_thread is None or not self.refill_thread.is_alive():
+            self.refill_thread = threading.Thread(target=self.refill_warm_pool, daemon=True)
+            self.refill_thread.start()
+
+    def refill_warm_pool(self):
+        while True:
+            job_kwargs = self.warm_job_kwargs
+            fingerprint = environment_fingerprint(job_kwargs.get("setup_cmds"), job_kwargs.get("install_cmd"))
+            with self.lock:
+                # Forget the warm TPUs that were preempted or deleted.
+                self.warm_tpus = {
+                    name: (tpu, fp) for name, (tpu, fp) in self.warm_tpus.items() if name in tpu.inventory.names
+                }
+                # Renew the leases, so the warm TPUs stay ours until a job takes them.
+                for name in self.warm_tpus:
+                    self.ledger.claim(name)
+                missing = self.warm_pool_size - [fp for _, fp in self.warm_tpus.values()].count(fingerprint)
+                new_names = [self.new_tpu_name() for _ in range(missing)]
+            # The TPUs are created concurrently, then set up one after the other.
+            operations = {name: self.provisioner.provision(name) for name in new_names}
+            for name, operation in operations.items():
+                self.warm_tpu(name, operation.result(), job_kwargs, fingerprint)
+            time.sleep(WARM_POOL_INTERVAL)
+
+    def warm_tpu(self, name, tpu, job_kwargs, fingerprint):
+        print(f"Warming up tpu {name}")
+        ok = False
+        if tpu is not None:
+            try:
+                ok = tpu.prepare(
+                    job_kwargs.get("setup_cmds"), job_kwargs.get("install_cmd"), job_kwargs.get("env_stmts") or []
+                )
+            except Exception as e:
+                print(f"Failed to warm up tpu {name}: {e}")
+            if not ok:
+                tpu.delete()
+        if not ok:
+            self.ledger.release(name)
+        with self.lock:
+            self.disarmed_but_busy_tpus.discard(name)
+            if ok:
+                self.warm_tpus[name] = (tpu, fingerprint)
@@ -1,35 +1,35 @@
 import os
 import sys
+import json
 import signal
 import click
 from wormulon.tpu.bucket import Bucket
 from wormulon.tpu.fncall import FunctionCall
-from wormulon.train_state import TrainState
-from wormulon.utils import dump_yaml, JobState
+from wormulon.tpu.checkpoint import wait_for_checkpoints
+from wormulon.train_state import STATE_DICT_GROUPS
+from wormulon.utils import dump_yaml, JobState, JOB_END_SENTINEL
 import torch_xla.distributed.xla_multiprocessing as xmp
 
-def _mp_fn(index, fn_call_buffer, bucket_name, job_state_path):
+# Seconds given to in-flight checkpoint uploads to finish when the job is preempted.
+CHECKPOINT_FLUSH_TIMEOUT = 20
+# Checkpoints are cached here, so a job restarting on the same TPU VM does not download them again.
+BLOB_CACHE_DIR = os.environ.get("WORMULON_BLOB_CACHE", "/tmp/wormulon-blob-cache")
+
+def _mp_fn(index, fn_call, bucket_name, job_state_path):
     print(f"Starting worker {index}", flush=True)
-    fn_call = FunctionCall.deserialize(fn_call_buffer)
-    bucket = Bucket(bucket_name)
-    try:
-        train_state = bucket.get_latest_trainstate(fn_call.trainer.experiment_directory)
-    except IndexError as e:
-        print(f"{e}. Failed to get_latest_trainstate, getting one on the functioncall", flush=True)
-        trainstate_buf = bucket.download(fn_call.trainstate)
-        train_state = TrainState.deserialize(trainstate_buf)
-    fn_call.trainstate = train_state
+    bucket = Bucket(bucket_name, cache_dir=BLOB_CACHE_DIR)
     fn_call.call()
 
     if fn_call.trainstate.step >= fn_call.trainer.get("num_train_steps") and index == 0:
         bucket.upload(job_state_path, dump_yaml({"state": JobState.SUCCESS.value, "tpu_name": fn_call.tpu_name}), overwrite=True)
     print(f"Finished worker {index} with output: {fn_call.outputs}", flush=True)
+    print(f"{JOB_END_SENTINEL} {json.dumps({'worker': index, 'step': fn_call.trainstate.step})}", flush=True)
     sys.exit(0)
 
 
 class JobRunner(object):
     def __init__(self, bucket_name, directory):
-        self.bucket = Bucket(bucket_name)
+        self.bucket = Bucket(bucket_name, cache_dir=BLOB_CACHE_DIR)
         self.directory = directory
         original_sigint = signal.getsignal(signal.SIGTERM)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
@@ -47,12 +47,28 @@ class JobRunner(object):
     def trainstate_path(self):
         return os.path.join(self.directory, "trainstate.pkl")
 
+    def load_trainstate(self, fn_call):
+        try:
+            # Fetch every state dict now, so that the workers don't each fetch the lazy ones themselves.
+            return self.bucket.get_latest_trainstate(fn_call.trainer.experiment_directory, groups=STATE_DICT_GROUPS)
+        except IndexError as e:
+            print(f"{e}. Failed to get_latest_trainstate, getting one on the functioncall", flush=True)
+            if isinstance(fn_call.trainstate, str):
+                return self.bucket.download_trainstate(fn_call.trainstate)
+            return fn_call.trainstate
+
     def run(self):
-        fn_call_buffer = self.bucket.download(self.fn_call_path)
-        xmp.spawn(_mp_fn, args=(fn_call_buffer.getvalue(), self.bucket.name, self.job_state_path), nprocs=8, daemon=False, start_method="fork")
+        # The function call and train state are decoded once, here. The workers are forked, so they
+        # share these objects (and the tensor storage in them) copy-on-write instead of each
+        # unpickling and downloading their own.
+        fn_call = FunctionCall.deserialize(self.bucket.download(self.fn_call_path).getvalue())
+        fn_call.trainstate = self.load_trainstate(fn_call)
+        xmp.spawn(_mp_fn, args=(fn_call, self.bucket.name, self.job_state_path), nprocs=8, daemon=False, start_method="fork")
 
     def exit_gracefully(self, signum, frame):
         print("Job is exiting gracefully")
+        if not wait_for_checkpoints(timeout=CHECKPOINT_FLUSH_TIMEOUT):
+            print("Some checkpoint uploads did not finish before exiting", flush=True)
         self.bucket.upload(self.job_state_path, dump_yaml({"state": JobState.PREEMPTED.value}), overwrite=True)
         sys.exit(0)
 
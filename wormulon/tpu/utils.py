@@ -2,32 +2,36 @@ import click
 import time
 from pathlib import Path
 from wormulon.tpu.tpu import TPU
+from wormulon.tpu.inventory import get_inventory
 from wormulon.tpu.bucket import Bucket
-from wormulon.utils import JobState, execute, dump_yaml
+from wormulon.tpu.retention import KeepLast, KeepEvery, KeepBest, collect_garbage
+from wormulon.utils import JobState, dump_yaml
 
 
 @click.command(context_settings={})
 @click.argument("bucket_name")
 @click.option("--filter")
-def show_jobs(bucket_name, filter=None):
+@click.option("--prefix")
+def show_jobs(bucket_name, filter=None, prefix=None):
     bucket = Bucket(bucket_name)
     if filter:
         filter = [JobState[filter]]
     else:
         filter = []
-    bucket.list_jobs(filter)
+    bucket.list_jobs(filter, prefix=prefix)
 
 @click.command(context_settings={})
 @click.argument("bucket_name")
 @click.option("--filter")
 @click.option("--wipe")
-def delete_jobs(bucket_name, filter=None, wipe=False):
+@click.option("--prefix")
+def delete_jobs(bucket_name, filter=None, wipe=False, prefix=None):
     bucket = Bucket(bucket_name)
     if filter:
         filter = [JobState[filter]]
     else:
         filter = []
-    jobs = bucket.list_jobs(filter)
+    jobs = bucket.list_jobs(filter, prefix=prefix)
     for job in jobs:
         job_id = Path(job['blob'].name).parent
         if wipe:
@@ -52,21 +56,49 @@ def nuke_exps():
 
 @click.command(context_settings={})
 @click.argument("bucket_name")
-def show_experiments(bucket_name):
+@click.option("--prefix")
+def show_experiments(bucket_name, prefix=None):
     bucket = Bucket(bucket_name)
-    bucket.list_experiments()
+    bucket.list_experiments(prefix=prefix)
+
+
+@click.command(context_settings={})
+@click.argument("bucket_name")
+@click.option("--prefix")
+@click.option("--keep-last", type=int)
+@click.option("--keep-every", type=int)
+@click.option("--keep-best", help="Name of a metric stored in the checkpoints' blob metadata.")
+@click.option("--keep-best-n", type=int, default=1)
+@click.option("--mode", type=click.Choice(["min", "max"]), default="min")
+@click.option("--dry-run", is_flag=True)
+def gc_checkpoints(bucket_name, prefix=None, keep_last=None, keep_every=None, keep_best=None, keep_best_n=1,
+                   mode="min", dry_run=False):
+    policies = retention_policies(keep_last, keep_every, keep_best, keep_best_n, mode)
+    if not policies:
+        # Without a policy, every checkpoint but the newest of each experiment would be deleted.
+        raise click.UsageError("Give at least one of --keep-last, --keep-every or --keep-best.")
+    if prefix is None and not dry_run:
+        click.confirm(f"No --prefix given, collect garbage in every experiment of {bucket_name}?", abort=True)
+    collect_garbage(Bucket(bucket_name), policies, prefix=prefix, dry_run=dry_run)
+
+
+def retention_policies(keep_last=None, keep_every=None, keep_best=None, keep_best_n=1, mode="min"):
+    policies = []
+    if keep_last is not None:
+        policies.append(KeepLast(keep_last))
+    if keep_every is not None:
+        policies.append(KeepEvery(keep_every))
+    if keep_best is not None:
+        policies.append(KeepBest(keep_best, n=keep_best_n, mode=mode))
+    return policies
 
 
 @click.command(context_settings={})
 def show_tpus():
     zones = ["us-central1-f", "europe-west4-a"]
     for zone in zones:
-        command = f"gcloud compute tpus list --format=value(NAME,STATUS) --zone {zone}"
-        stdout, stderr, retcode = execute(command.split(), capture_output=True)
-        rows = stdout.split("\n")
-        rows.remove("")
-        for row in rows:
-            print(row + f"\t {zone}")
+        for tpu in get_inventory(zone).tpus.values():
+            print(f"{tpu.name}\t{tpu.state}\t {zone}")
 
 def delete_tpus():
     zones = ["us-central1-f", "europe-west4-a"]
@@ -81,15 +113,10 @@ def delete_tpus():
         }
 
     for zone in zones:
-        command = f"gcloud compute tpus list --format=value(NAME,STATUS) --zone {zone}"
-        stdout, stderr, retcode = execute(command.split(), capture_output=True)
-        rows = stdout.split("\n")
-        rows.remove("")
         default_tpu_kwargs["zone"] = zone
-        for row in rows:
-            if row.split("\t")[1] == "READY":
-                tpu = TPU(row.split("\t")[0], **default_tpu_kwargs)
-                tpu.delete()
+        for name in get_inventory(zone).ready:
+            tpu = TPU(name, **default_tpu_kwargs)
+            tpu.delete()
 
 @click.command(context_settings={})
 def delete_all_tpus():
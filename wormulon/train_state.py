@@ -1,5 +1,8 @@
 import io
+import copy
+import hashlib
 import dill
+from collections import OrderedDict
 from typing import Union
 import torch
 import torch.nn as nn
@@ -11,12 +14,100 @@ except ImportError:
     xm = None
 
 
+# Layout of sharded checkpoints: a directory holding a manifest and one or more shards per state dict.
+MANIFEST_NAME = "manifest.yml"
+SHARD_SUFFIX = ".shard"
+STATE_DICT_GROUPS = ("model_state_dict", "losses_state_dict", "optims_state_dict", "schedulers_state_dict")
+# State dicts larger than this are split over several shards.
+MAX_SHARD_SIZE = 512 * 1024 * 1024
+# Marks a checkpoint that only holds the tensors that changed since its base checkpoint.
+DELTA_FORMAT = "delta"
+
+
 class NotAvailable(object):
     @classmethod
     def it_is(cls, obj):
         return isinstance(obj, cls)
 
 
+class LazyShards(object):
+    """Stands in for a state dict of a sharded checkpoint until it is needed.
+    `loader` is called with the shard names and returns the list of partial state dicts."""
+
+    def __init__(self, shard_names, loader):
+        self.shard_names = shard_names
+        self.loader = loader
+
+    def load(self):
+        state_dict = {}
+        for part in self.loader(self.shard_names):
+            state_dict.update(part)
+        return state_dict
+
+
+def to_host(obj):
+    """Copies every tensor in a (nested) state dict to host memory."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        copied = type(obj)((key, to_host(value)) for key, value in obj.items())
+        if hasattr(obj, "_metadata"):
+            # nn.Module.state_dict stores version info here, which load_state_dict needs.
+            copied._metadata = obj._metadata
+        return copied
+    if isinstance(obj, (list, tuple)) and type(obj) in (list, tuple):
+        return type(obj)(to_host(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def flatten(obj, path=()):
+    """Flattens nested dicts into a {key path: leaf} dict."""
+    if isinstance(obj, dict) and obj:
+        leaves = {}
+        for key, value in obj.items():
+            leaves.update(flatten(value, path + (key,)))
+        return leaves
+    return {path: obj}
+
+
+def unflatten(leaves):
+    root = OrderedDict()
+    for path, value in leaves.items():
+        if not path:
+            return value
+        node = root
+        for key in path[:-1]:
+            node = node.setdefault(key, OrderedDict())
+        node[path[-1]] = value
+    return root
+
+
+# Integer dtypes of the same width as a tensor's elements. Tensor.view(dtype) can only change the element
+# size from torch 1.11 on, and numpy has no bfloat16, so tensors are hashed through these.
+HASH_DTYPES = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+def tensor_hash(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    digest = hashlib.blake2b(f"{tensor.dtype}{tuple(tensor.shape)}".encode(), digest_size=16)
+    hash_dtype = HASH_DTYPES.get(tensor.element_size())
+    if hash_dtype is None:
+        digest.update(tensor.numpy().tobytes())
+    else:
+        digest.update(tensor.reshape(-1).view(hash_dtype).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def nbytes(obj):
+    if torch.is_tensor(obj):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    return 0
+
+
 @dataclass
 class TrainState(object):
     step: int
@@ -27,27 +118,140 @@ class TrainState(object):
     schedulers_state_dict: Union[dict, NotAvailable]
     misc_attributes: dict = field(default_factory=dict)
 
-    def serialize(self):
-        states = {
+    @property
+    def states(self):
+        return {
             "step": self.step,
             "epoch": self.epoch,
-            "model_state_dict": self.model_state_dict,
-            "losses_state_dict": self.losses_state_dict,
-            "optims_state_dict": self.optims_state_dict,
-            "schedulers_state_dict": self.schedulers_state_dict,
+            "model_state_dict": self.resolve("model_state_dict"),
+            "losses_state_dict": self.resolve("losses_state_dict"),
+            "optims_state_dict": self.resolve("optims_state_dict"),
+            "schedulers_state_dict": self.resolve("schedulers_state_dict"),
             "misc_attributes": self.misc_attributes,
         }
-        buffer = io.BytesIO()
+
+    def resolve(self, group):
+        """Returns the state dict `group`, fetching its shards first if it is still lazy."""
+        state_dict = getattr(self, group)
+        if isinstance(state_dict, LazyShards):
+            state_dict = state_dict.load()
+            setattr(self, group, state_dict)
+        return state_dict
+
+    @property
+    def is_writer(self):
+        # xm.save only writes on the master ordinal.
+        return xm is None or xm.is_master_ordinal()
+
+    def save(self, fp):
+        """Writes the train state to a file-like object, e.g. a file or a GCS blob writer."""
         if xm is not None:
-            xm.save(states, buffer)
+            xm.save(self.states, fp)
         else:
-            torch.save(states, buffer)
+            torch.save(self.states, fp)
+        return fp
 
+    def serialize(self):
+        buffer = io.BytesIO()
+        self.save(buffer)
         return buffer.getvalue()
 
+    def shards(self, max_shard_size=MAX_SHARD_SIZE):
+        """Splits the train state for a sharded checkpoint. Returns a manifest and a {shard_name: object}
+        dict with one "meta" shard and one or more shards per state dict, split at its top-level keys."""
+        states = self.states
+        if xm is not None:
+            states = xm._maybe_convert_to_cpu(states)
+        shards = {f"meta{SHARD_SUFFIX}": {key: states[key] for key in ("step", "epoch", "misc_attributes")}}
+        manifest = {"step": self.step, "epoch": self.epoch, "groups": {}}
+        for group in STATE_DICT_GROUPS:
+            state_dict = states[group]
+            if NotAvailable.it_is(state_dict):
+                manifest["groups"][group] = None
+                continue
+            parts, size = [{}], 0
+            for key, value in state_dict.items():
+                value_size = nbytes(value)
+                if parts[-1] and size + value_size > max_shard_size:
+                    parts.append({})
+                    size = 0
+                parts[-1][key] = value
+                size += value_size
+            names = [f"{group}-{idx}{SHARD_SUFFIX}" for idx in range(len(parts))]
+            shards.update(zip(names, parts))
+            manifest["groups"][group] = names
+        return manifest, shards
+
+    @classmethod
+    def from_shards(cls, manifest, meta, loader, groups=None):
+        """Builds a train state from a sharded checkpoint. The state dicts in `groups` are fetched now,
+        the others only when first used (e.g. by load_in_optims), so unused ones are never downloaded."""
+        state_dicts = {}
+        for group in STATE_DICT_GROUPS:
+            names = manifest["groups"].get(group)
+            state_dicts[group] = NotAvailable() if names is None else LazyShards(names, loader)
+        for group in groups or ():
+            if isinstance(state_dicts[group], LazyShards):
+                state_dicts[group] = state_dicts[group].load()
+        return cls(step=meta["step"], epoch=meta["epoch"], misc_attributes=meta["misc_attributes"], **state_dicts)
+
+    def tensor_hashes(self):
+        """Content hashes of every tensor, as {state dict: {key path: hash}}."""
+        hashes = {}
+        for group in STATE_DICT_GROUPS:
+            state_dict = self.resolve(group)
+            if not NotAvailable.it_is(state_dict):
+                hashes[group] = {path: tensor_hash(leaf) for path, leaf in flatten(state_dict).items()
+                                 if torch.is_tensor(leaf)}
+        return hashes
+
+    def delta(self, base_path, base_hashes):
+        """Returns the states of a delta checkpoint against the checkpoint at base_path, whose tensor
+        hashes are base_hashes, along with the tensor hashes of this train state. Tensors with an unchanged
+        hash are left out and read from the base checkpoint on restore; everything else is kept."""
+        hashes = self.tensor_hashes()
+        states = {"format": DELTA_FORMAT, "base": base_path, "step": self.step, "epoch": self.epoch,
+                  "misc_attributes": self.misc_attributes}
+        for group in STATE_DICT_GROUPS:
+            state_dict = self.resolve(group)
+            if NotAvailable.it_is(state_dict):
+                states[group] = None
+                continue
+            leaves = flatten(state_dict)
+            unchanged = {path for path, digest in hashes[group].items()
+                         if base_hashes.get(group, {}).get(path) == digest}
+            states[group] = {
+                "paths": list(leaves),
+                "leaves": {path: leaf for path, leaf in leaves.items() if path not in unchanged},
+                "metadata": getattr(state_dict, "_metadata", None),
+            }
+        return states, hashes
+
+    @classmethod
+    def from_delta(cls, states, base):
+        """Rebuilds the full train state of a delta checkpoint from its base train state."""
+        state_dicts = {}
+        for group in STATE_DICT_GROUPS:
+            delta = states[group]
+            if delta is None:
+                state_dicts[group] = NotAvailable()
+                continue
+            base_leaves = flatten(base.resolve(group))
+            state_dict = unflatten({path: delta["leaves"][path] if path in delta["leaves"] else base_leaves[path]
+                                    for path in delta["paths"]})
+            if delta["metadata"] is not None:
+                state_dict._metadata = delta["metadata"]
+            state_dicts[group] = state_dict
+        return cls(step=states["step"], epoch=states["epoch"], misc_attributes=states["misc_attributes"],
+                   **state_dicts)
+
     @classmethod
-    def deserialize(cls, buffer):
+    def deserialize(cls, buffer, base_loader=None):
+        """Loads a train state. Delta checkpoints also need base_loader, which is called with the path
+        of the base checkpoint and returns its TrainState."""
         states = torch.load(buffer)
+        if states.get("format") == DELTA_FORMAT:
+            return cls.from_delta(states, base_loader(states["base"]))
         return cls(
             step=states["step"],
             epoch=states["epoch"],
@@ -71,13 +275,13 @@ class TrainState(object):
         )
 
     def load_in_model(self, model: nn.Module):
-        if NotAvailable.it_is(self.model_state_dict):
+        if NotAvailable.it_is(self.resolve("model_state_dict")):
             return model
         model.load_state_dict(self.model_state_dict)
         return model
 
     def load_in_losses(self, **losses):
-        if NotAvailable.it_is(self.losses_state_dict):
+        if NotAvailable.it_is(self.resolve("losses_state_dict")):
             return losses
         for key, loss in losses.items():
             if loss is not None:
@@ -85,7 +289,7 @@ class TrainState(object):
         return losses
 
     def load_in_optims(self, **optims):
-        if NotAvailable.it_is(self.optims_state_dict):
+        if NotAvailable.it_is(self.resolve("optims_state_dict")):
             return optims
         for key, optim in optims.items():
             if optim is not None:
@@ -93,16 +297,31 @@ class TrainState(object):
         return optims
 
     def load_in_schedulers(self, **schedulers):
-        if NotAvailable.it_is(self.schedulers_state_dict):
+        if NotAvailable.it_is(self.resolve("schedulers_state_dict")):
             return schedulers
         for key, scheduler in schedulers.items():
             if scheduler is not None:
                 scheduler.load_state_dict(self.schedulers_state_dict[key])
         return schedulers
 
+    def to_host(self):
+        """Returns a copy of the train state with all tensors in host memory."""
+        states = to_host(self.states)
+        return HostTrainState(**states)
+
     @classmethod
     def is_instance(cls, obj):
         return isinstance(obj, cls) or (obj.__class__.__name__ == cls.__name__)
 
     def __str__(self):
-        return f"{self.__class__.__name__}(step={self.step}, epoch={self.epoch}), {self.misc_attributes}"
\ No newline at end of file
+        return f"{self.__class__.__name__}(step={self.step}, epoch={self.epoch}), {self.misc_attributes}"
+
+
+class HostTrainState(TrainState):
+    """A TrainState whose tensors were copied to host memory. It is saved with torch.save, so unlike
+    xm.save it does not need every ordinal to take part and can be written from a background thread."""
+    is_writer = True
+
+    def save(self, fp):
+        torch.save(self.states, fp)
+        return fp
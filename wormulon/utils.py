@@ -19,6 +19,11 @@ class JobState(Enum):
     UNKNOWN = 8
 
 
+# Printed by each TPU worker when it is done, followed by a JSON payload, so the launcher can tell
+# a finished job from a dropped connection.
+JOB_END_SENTINEL = "WORMULON-JOB-END"
+
+
 def execute(command, capture_output=False, run_async=False, check=True, timeout=100):
     output = ("", "", 0)
     try: